@@ -1,5 +1,13 @@
 import os
 import sys
+import time
+import itertools
+import hashlib
+import shutil
+import tempfile
+import json
+import heatwave_history
+import heatwave_view
 import networkx as nx
 import math
 import statistics
@@ -61,40 +69,213 @@ transfer_rate = 0.25
 if len(sys.argv) > 9:
     transfer_rate = float(sys.argv[9])
 
-node_label = {}
-node_fc = {}
-def load_nodes(fname):    
-    with open(fname, 'r') as file:
-        file.readline()  # headers
-        for line in file:
-            vals = line.strip().split("\t")
-            node_id = vals[0]
-            fc = float(vals[1])
-            label = vals[2]
-            if (node_id not in node_fc) or (abs(fc) > abs(node_fc[node_id])):
-                node_fc[node_id] = fc
-                node_label[node_id] = label
+result_cache_dir = None  # e.g. "heatwave_cache": reruns with identical inputs and parameters restore their outputs from here
+if len(sys.argv) > 10 and sys.argv[10] != "None":
+    result_cache_dir = sys.argv[10]
+
+result_cache_mb = 1024.0  # least recently used results are evicted once the cache grows past this
+if len(sys.argv) > 11:
+    result_cache_mb = float(sys.argv[11])
 
+aggregate_view = False  # collapse communities of the pruned graph into supernodes that expand on demand (tap or "x")
+if len(sys.argv) > 12:
+    aggregate_view = (sys.argv[12] == "True")
 
-load_nodes(metabolomic_data)
-load_nodes(genomic_data)  # We are assuming that genomic data IDs and metabolomic data IDs never overlap (which is safe in the case of InChIK IDs)
+history_file = None  # e.g. "heatwave_history.bin": heat of every node after every wave (see heatwave_history.py)
+if len(sys.argv) > 13 and sys.argv[13] != "None":
+    history_file = sys.argv[13]
+
+pathway_selection = []  # e.g. "map00250,M00001": only load these pathways/modules from the shards of network_file
+if len(sys.argv) > 14 and sys.argv[14] != "None":
+    pathway_selection = sys.argv[14].split(",")
+
+network_files = [network_file]
+if pathway_selection:
+    shard_dir = os.path.splitext(network_file)[0] + "_shards"  # written by create_metagenomic_network.py
+    if not os.path.exists(os.path.join(shard_dir, "index.tsv")):
+        print(f"No pathway shards found for {network_file} ({os.path.join(shard_dir, 'index.tsv')} is missing)! Rebuild the network with create_metagenomic_network.py to select pathways/modules.")
+        sys.exit(-1)
+    shards = {}
+    with open(os.path.join(shard_dir, "index.tsv"), 'r') as index:
+        index.readline()  # headers
+        for line in index:
+            vals = line.rstrip("\n").split("\t")
+            shards[vals[0]] = os.path.join(shard_dir, vals[2])
+    network_files = []
+    for pathway in pathway_selection:
+        if pathway not in shards:
+            print(f"Pathway/module {pathway} not found in {os.path.join(shard_dir, 'index.tsv')}!")
+            sys.exit(-1)
+        network_files.append(shards[pathway])
+
+module_count = 0  # > 0: also extract this many hottest connected modules of the full network (after diffusion)
+if len(sys.argv) > 15:
+    module_count = int(sys.argv[15])
+
+module_offset = None  # a node adds (heat - module_offset) to the score of its module; None = 80th percentile heat of the measured nodes
+if len(sys.argv) > 16 and sys.argv[16] != "None":
+    module_offset = float(sys.argv[16])
+
+aggregate_limit = 200  # at most this many top-level nodes in the aggregated view (hottest communities first, then buckets)
+if len(sys.argv) > 17:
+    aggregate_limit = int(sys.argv[17])
+
+result_files = []  # the outputs actually written by this run (fewer modules than requested may exist)
+
+
+def remove_module_files():
+    # heatwave_module_* files of an earlier run with more modules must not pass for (or be cached as) this run's
+    for fname in os.listdir("."):
+        if fname.startswith("heatwave_module_") and fname.endswith((".tsv", ".html")):
+            os.remove(fname)
+
+
+def file_digest(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def result_cache_key():
+    # Content-addressed: the script itself, every input file, and every parameter that affects the outputs
+    h = hashlib.sha256()
+    for fname in [os.path.abspath(__file__), heatwave_history.__file__, heatwave_view.__file__, metabolomic_data, genomic_data] + network_files:
+        h.update(file_digest(fname).encode())
+    params = (heat_threshold, eliminate_singletons, hot_color, cold_color, wave_number, transfer_rate, aggregate_view, history_file, pathway_selection, module_count, module_offset, aggregate_limit)
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+def restore_result(entry):
+    try:
+        os.utime(entry)  # mark as most recently used
+        names = sorted(os.listdir(entry))
+        remove_module_files()
+        restored = []
+        for name in names:
+            fname = history_file if history_file and name == os.path.basename(history_file) else name
+            shutil.copyfile(os.path.join(entry, name), fname)
+            restored.append(fname)
+    except FileNotFoundError:  # evicted by another process in the meantime, just recompute
+        return False
+    print(f"Restored {', '.join(restored)} from result cache ({entry})")
+    return True
+
+
+def store_result(entry):
+    tmp = tempfile.mkdtemp(prefix=".tmp_", dir=result_cache_dir)
+    os.chmod(tmp, 0o755)  # mkdtemp is owner-only, but the cache may be shared
+    for fname in result_files:
+        shutil.copyfile(fname, os.path.join(tmp, os.path.basename(fname)))
+    try:
+        os.rename(tmp, entry)  # atomic, so concurrent readers never see a partially written entry
+    except OSError:  # another process stored the same result first
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict_results(keep=entry)
+
+
+def evict_results(keep):
+    entries = []
+    total = 0
+    for name in os.listdir(result_cache_dir):
+        entry = os.path.join(result_cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        except FileNotFoundError:
+            continue
+        total += size
+    for (mtime, size, entry) in sorted(entries):
+        if total <= result_cache_mb * 1024 * 1024:
+            break
+        if entry == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+result_entry = None
+if result_cache_dir:
+    os.makedirs(result_cache_dir, exist_ok=True)
+    result_entry = os.path.join(result_cache_dir, result_cache_key())
+    if os.path.isdir(result_entry) and restore_result(result_entry):
+        sys.exit(0)
 
 G = nx.DiGraph()
-with open(network_file, 'r') as myfile:
-    for line in myfile:
-        vals = line.strip().split("\t")
-        if vals[0] == "node":
-            node_id = vals[2]
-            G.add_node(node_id)
-            G.nodes[node_id]["class"] = vals[1]
-            G.nodes[node_id]["heat"] = 0
-            if node_id in node_fc:
-                G.nodes[node_id]["fc"] = node_fc[node_id]
-                G.nodes[node_id]["heat"] = abs(node_fc[node_id])
-        if vals[0] == "edge":
-            source = vals[1]
-            dest = vals[2]
-            G.add_edge(source, dest)
+node_index = {}  # node_id -> integer position in network file order
+edges = []
+for fname in network_files:  # with a pathway selection, the union of the selected shards
+    with open(fname, 'r') as myfile:
+        for line in myfile:
+            vals = line.strip().split("\t")
+            if vals[0] == "node":
+                node_id = vals[2]
+                if node_id in node_index:  # shared by several selected shards
+                    continue
+                G.add_node(node_id)
+                G.nodes[node_id]["class"] = vals[1]
+                G.nodes[node_id]["heat"] = 0
+                node_index[node_id] = len(node_index)
+            if vals[0] == "edge":
+                edges.append((vals[1], vals[2]))
+for (source, dest) in edges:
+    if source in node_index and dest in node_index:  # a shard also lists the edges leaving its pathway
+        G.add_edge(source, dest)
+node_ids = numpy.array(list(node_index.keys()), dtype=object)
+
+chunk_rows = 1 << 16  # rows parsed at a time, bounds memory on gene-catalog-sized tables
+best_abs_fc = numpy.full(len(node_ids), -1.0)
+best_fc = numpy.zeros(len(node_ids))
+best_label = numpy.empty(len(node_ids), dtype=object)
+def load_nodes(fname):
+    # Chunked loader: map each row's ID straight to its network node index (rows whose ID is not in the
+    # network are dropped here), parse the fold changes of the remaining rows as floats, keep the max-|fc|
+    # row per node, and only split out the labels of the winning rows.
+    # Ties go to the earliest row, as in the original line-by-line loader.
+    tot_rows = 0
+    dropped_rows = 0
+    with open(fname, 'r') as file:
+        file.readline()  # headers
+        while True:
+            lines = list(itertools.islice(file, chunk_rows))
+            if not lines:
+                break
+            tot_rows += len(lines)
+            idx = numpy.array([node_index.get(line.partition("\t")[0].strip(), -1) for line in lines], dtype=numpy.int64)
+            rows = numpy.flatnonzero(idx >= 0)
+            dropped_rows += len(lines) - len(rows)
+            if len(rows) == 0:
+                continue
+            idx = idx[rows]
+            fc = numpy.loadtxt([lines[r] for r in rows], delimiter="\t", dtype=float, comments=None, ndmin=1, usecols=(1,))
+            abs_fc = numpy.abs(fc)
+            order = numpy.lexsort((numpy.arange(len(idx)), -abs_fc, idx))
+            first = numpy.ones(len(order), dtype=bool)
+            first[1:] = idx[order[1:]] != idx[order[:-1]]
+            winners = order[first]
+            better = abs_fc[winners] > best_abs_fc[idx[winners]]
+            winners = winners[better]
+            best_abs_fc[idx[winners]] = abs_fc[winners]
+            best_fc[idx[winners]] = fc[winners]
+            best_label[idx[winners]] = [lines[rows[w]].split("\t")[2].strip() for w in winners]
+    return (tot_rows, dropped_rows)
+
+
+(metabolite_rows, unmatched_metabolite_rows) = load_nodes(metabolomic_data)
+(ortholog_rows, unmatched_ortholog_rows) = load_nodes(genomic_data)  # We are assuming that genomic data IDs and metabolomic data IDs never overlap (which is safe in the case of InChIK IDs)
+
+node_label = {}
+node_fc = {}
+for i in numpy.flatnonzero(best_abs_fc >= 0):
+    node_id = node_ids[i]
+    node_fc[node_id] = float(best_fc[i])
+    node_label[node_id] = best_label[i]
+    G.nodes[node_id]["fc"] = node_fc[node_id]
+    G.nodes[node_id]["heat"] = abs(node_fc[node_id])
 
 tot_nodes = len(G.nodes)
 tot_edges = len(G.edges)
@@ -118,6 +299,8 @@ for node in G.nodes:
             ortholog_abs_fcs.append(G.nodes[node]["heat"])
 
 print("**********************")
+if pathway_selection:
+    print(f"Selected Pathways/Modules: {', '.join(pathway_selection)}")
 print(f"Reference Network Nodes: {tot_nodes}")
 print(f"Reference Network Metabolites: {tot_metabolites}")
 print(f"Reference Network Orthologs: {tot_reactions}")
@@ -125,23 +308,140 @@ print(f"Reference Network Edges: {tot_edges}")
 print("**********************")
 print(f"Measured Metabolites: {tot_measured_metabolites}")
 print(f"Measured Orthologs: {tot_measured_reactions}")
-print(f"Median Metabolite Absolute FC: {2**statistics.median(metabolite_abs_fcs):.2f}")
-print(f"Median Ortholog Absolute FC: {2**statistics.median(ortholog_abs_fcs):.2f}")
-
+unmatched = "not in selected subnetwork" if pathway_selection else "not in network"  # rows outside the selected shards are dropped too
+print(f"Unmatched Metabolite Rows ({unmatched}): {unmatched_metabolite_rows} of {metabolite_rows}")
+print(f"Unmatched Ortholog Rows ({unmatched}): {unmatched_ortholog_rows} of {ortholog_rows}")
+if metabolite_abs_fcs:  # a small pathway selection may contain no measured metabolites or orthologs
+    print(f"Median Metabolite Absolute FC: {2**statistics.median(metabolite_abs_fcs):.2f}")
+if ortholog_abs_fcs:
+    print(f"Median Ortholog Absolute FC: {2**statistics.median(ortholog_abs_fcs):.2f}")
+
+history_writer = None
+if history_file:
+    history_writer = heatwave_history.HistoryWriter(history_file, list(node_ids))
+    result_files.append(history_file)
+
+# Each wave, a node gains transfer_rate times the mean heat of its neighbors; done over node index arrays so
+# large wave counts stay cheap (edges are in G.neighbors() order, so the sums match a per-node loop exactly).
+heat = numpy.array([G.nodes[n]["heat"] for n in node_ids], dtype=float)
+edge_src = numpy.array([node_index[u] for (u, v) in G.edges], dtype=numpy.int64)
+edge_dst = numpy.array([node_index[v] for (u, v) in G.edges], dtype=numpy.int64)
+neighbor_count = numpy.bincount(edge_src, minlength=len(node_ids))
+if history_writer:
+    history_writer.append(heat)
 for t in range(wave_number):
-    for n in G.nodes:
-        ocount = 0
-        otot = 0
-        o_heat = 0
-        for o in G.neighbors(n):
-            ocount += 1
-            otot += G.nodes[o]["heat"]
-        if otot > 0:
-            o_heat = otot / ocount
-        G.nodes[n]["o_heat"] = o_heat
-    for n in G.nodes:
-        G.nodes[n]["heat"] += transfer_rate*G.nodes[n]["o_heat"]
-
+    otot = numpy.bincount(edge_src, weights=heat[edge_dst], minlength=len(node_ids))
+    o_heat = numpy.divide(otot, neighbor_count, out=numpy.zeros(len(node_ids)), where=(otot > 0))
+    heat += transfer_rate*o_heat
+    if history_writer:
+        history_writer.append(heat)
+if history_writer:
+    history_writer.close()
+if wave_number > 0:
+    for (i, n) in enumerate(node_ids):
+        G.nodes[n]["heat"] = float(heat[i])
+
+
+def hottest_modules(heat, edge_src, edge_dst, k, offset):
+    # Top-k highest-scoring connected subgraphs, where a subgraph scores sum(heat - offset) over its nodes.
+    # Nodes are added hottest first while a union-find tracks the connected components of the nodes added so
+    # far; every component (a branch of the resulting merge tree, from its creation until it merges) remembers
+    # the point at which its score peaked. The k best branches that do not contain one another are returned.
+    # Candidates are thus connected parts of heat superlevel sets (an exact search would be NP-hard).
+    n = len(heat)
+    ends = numpy.concatenate([edge_src, edge_dst])
+    others = numpy.concatenate([edge_dst, edge_src])
+    order = numpy.argsort(ends, kind="stable")
+    neighbors = others[order].tolist()
+    starts = numpy.searchsorted(ends[order], numpy.arange(n + 1)).tolist()
+    sweep = numpy.lexsort((numpy.arange(n), -heat)).tolist()
+    added_at = [n] * n
+    uf = list(range(n))
+
+    def find(x):
+        while uf[x] != x:
+            uf[x] = uf[uf[x]]
+            x = uf[x]
+        return x
+
+    branch_of = {}  # union-find root -> branch
+    score = []
+    best = []
+    best_at = []
+    seed = []
+    parent = []
+    children = []
+    for (t, v) in enumerate(sweep):
+        added_at[v] = t
+        roots = set(find(u) for u in neighbors[starts[v]:starts[v + 1]] if added_at[u] < t)
+        gain = heat[v] - offset
+        if len(roots) == 1:
+            r = roots.pop()
+            b = branch_of[r]
+            uf[v] = r
+            score[b] += gain
+            if score[b] > best[b]:
+                best[b] = score[b]
+                best_at[b] = t
+            continue
+        b = len(score)
+        merged = [branch_of.pop(r) for r in roots]
+        score.append(gain + sum(score[c] for c in merged))
+        best.append(score[b])
+        best_at.append(t)
+        seed.append(v)
+        parent.append(-1)
+        children.append(merged)
+        for c in merged:
+            parent[c] = b
+        for r in roots:
+            uf[r] = v
+        branch_of[v] = b
+
+    blocked = [False] * len(score)
+    modules = []
+    for b in sorted(range(len(score)), key=lambda b: (-best[b], b)):
+        if len(modules) == k or best[b] <= 0:
+            break
+        if blocked[b]:
+            continue
+        # members: the component of the seed among the nodes added up to the peak
+        members = [seed[b]]
+        seen = set(members)
+        for x in members:
+            for u in neighbors[starts[x]:starts[x + 1]]:
+                if added_at[u] <= best_at[b] and u not in seen:
+                    seen.add(u)
+                    members.append(u)
+        modules.append((best[b], sorted(members)))
+        a = b
+        while a != -1 and not blocked[a]:  # ancestors contain this module...
+            blocked[a] = True
+            a = parent[a]
+        stack = list(children[b])
+        while stack:  # ...and descendants are contained in it
+            c = stack.pop()
+            if not blocked[c]:
+                blocked[c] = True
+                stack.extend(children[c])
+    return modules
+
+
+modules = []
+if module_count > 0:
+    if module_offset is None:
+        # Not the mean over the whole network: most nodes are unmeasured zeros, so that offset lets cold hubs
+        # join nearly every hot node into one giant module. Only about the hottest fifth of the measured nodes
+        # score positively with this default.
+        measured = heat[best_abs_fc >= 0]
+        module_offset = float(numpy.quantile(measured, 0.8)) if len(measured) else 0.0
+    module_start = time.time()
+    for (module_score, members) in hottest_modules(heat, edge_src, edge_dst, module_count, module_offset):
+        modules.append((module_score, G.subgraph(node_ids[members]).copy()))
+    print("**********************")
+    print(f"Hottest Modules (offset {module_offset:.3f}, {time.time() - module_start:.3f}s):")
+    for (i, (module_score, M)) in enumerate(modules):
+        print(f"Module {i + 1}: {len(M.nodes)} nodes, {len(M.edges)} edges, score {module_score:.2f}")
 
 
 to_remove = set()
@@ -184,6 +484,10 @@ print("**********************")
 for node in G.nodes:
     if node not in node_label:
         node_label[node] = node
+for (module_score, M) in modules:
+    for node in M.nodes:
+        if node not in node_label:
+            node_label[node] = node
 
 from matplotlib import colors
 from matplotlib.colors import LinearSegmentedColormap
@@ -197,313 +501,187 @@ def fc(fc_in):
     return colors.to_hex(cmap(fc_out))
 
 
-viz = open(f"heatwave.html", 'w')
-
-print("""
-    <html>
-    <head>
-    <title>Multi-Omic HeatWave Visualization</title>
-    <meta name="viewport" content="width=device-width, user-scalable=no, initial-scale=1, maximum-scale=1">
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/cytoscape/3.23.0/cytoscape.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/gh/cytoscape/cytoscape.js-pdf-export@main/dist/cytoscape-pdf-export.js"></script>    
-    <style>
-            body {
-                font-family: helvetica;
-                font-size: 14px;
-            }
-
-            #cy {
-                width: 100%;
-                height: 100%;
-                position: absolute;
-                left: 0;
-                top: 0;
-                z-index: 999;
-            }
-
-            h1 {
-                opacity: 0.5;
-                font-size: 1em;
-            }
-        </style>
-
-        <script>
-            var checkpoint = null;
-            var checkpoint_style = [{
-                    selector: 'node',
-                    labelValign: 'middle',
-                    style: {
-                        'text-valign': function(ele) {if (ele.data('shape') === "ellipse") { return "top" } else { return "top" } },
-                        'width': function(ele) {if (ele.data('shape') === "ellipse") { return 30 } else { return 30 } },
-                        'height': function(ele) {if (ele.data('shape') === "ellipse") { return 30 } else { return 30 } },
-                        'font-weight': function(ele) { if (ele.data('shape') === "ellipse") { return 'bold' } else { return "normal" } },
-                        'font-size': function(ele) { if (ele.data('shape') === "ellipse") { return '16px' } else { return "12px" } },
-                        'color': function(ele) { if (ele.data('shape') === "ellipse") { return 'darkblue' } else { return "black" } },
-                        'content': 'data(label)',
-                        'border-width': 1,
-                        //'border-color': 'black',
-                        'background-color': function(ele) { return ele.data('bg') },
-                        'shape': function(ele) { return ele.data('shape') }
-                    }
-                },
-
-
-                {
-                    selector: 'edge',
-                    style: {
-                        'curve-style': 'bezier',
-                        'source-arrow-shape': 'triangle',
-                        'target-arrow-shape': 'triangle'
-                    },
-                    css: {
-                        'line-color': '#cccbcb' //'#f92411'
-                    }
-                },
-
-                {
-                    selector: ':selected',
-                    style: {
-                        'background-color': 'purple',
-                        'line-color': 'purple',
-                        'source-arrow-color': 'purple',
-                        'target-arrow-color': 'purple'
-                    }
-                }
-            ];        
-            document.addEventListener('DOMContentLoaded', function(){
-
-                var cy = window.cy = cytoscape({
-                    container: document.getElementById('cy'),
-
-                    autounselectify: false,
-                    
-                    boxSelectionEnabled: true,
-
-                    layout: {
-                        name: 'cose',
-                        nodeOverlap: 1000,
-                        animate: false,
-                        //idealEdgeLength: 50,
-                        nodeDimensionsIncludeLabels: false,
-                    },
-
-                    style: checkpoint_style,
-
-                    elements: {
-                      nodes: [
-""", file=viz)
-
-for n in G.nodes:
-    if "fc" in G.nodes[n]:
-        color = fc(G.nodes[n]["fc"])
+def node_data(H, n):
+    if "fc" in H.nodes[n]:
+        color = fc(H.nodes[n]["fc"])
     else:
         color = "#D3D3D3"
-    if G.nodes[n]["class"] == "reaction":
-        shape = "rectangle"
-        link = "https://www.genome.jp/entry/"
-    else:
-        shape = "ellipse"
-        link = "https://www.ebi.ac.uk/chebi/advancedSearchFT.do?searchString="
-    # NOTE: It is essential that nodel_labels _not_ contain double-quotes (")
-    print(f"""
+    (shape, url) = heatwave_view.node_link(H.nodes[n]["class"], n)
+    return {"id": n, "label": node_label[n], "bg": color, "url": url, "shape": shape}
+
+
+def aggregate_graph(H, limit):
+    # Level-of-detail view: every community (found by Louvain on the pruned graph) of more than one node
+    # collapses into a supernode, and parallel edges between supernodes collapse into one weighted edge.
+    # If that still leaves more than limit top-level nodes (e.g. many singletons), only the hottest communities
+    # keep their own supernode and all other nodes go into one bucket supernode per class.
+    # (on an undirected copy with integer labels: the undirected view and sets of string labels would both make the
+    # result depend on PYTHONHASHSEED)
+    nodes = list(H.nodes)
+    communities = nx.community.louvain_communities(nx.convert_node_labels_to_integers(H.to_undirected()), seed=19700101)
+    communities = [sorted(nodes[i] for i in c) for c in communities if len(c) > 1]
+    communities.sort(key=lambda c: -sum(H.nodes[n]["heat"] for n in c))
+    groups = [(f"cluster_{i}", members, None) for (i, members) in enumerate(communities)]
+    clustered = set(n for members in communities for n in members)
+    singletons = [n for n in nodes if n not in clustered]
+    if len(communities) + len(singletons) > limit:
+        node_classes = sorted(set(H.nodes[n]["class"] for n in nodes))
+        keep = max(limit - len(node_classes), 0)
+        rest = singletons + [n for members in communities[keep:] for n in members]
+        groups = groups[:keep]
+        for node_class in node_classes:
+            members = sorted(n for n in rest if H.nodes[n]["class"] == node_class)
+            name = {"metabolite": "metabolites", "reaction": "orthologs"}.get(node_class, node_class)
+            if members:
+                groups.append((f"cluster_other_{name}", members, f"other {name} ({len(members)})"))
+    A = nx.Graph()
+    clusters = {}
+    cluster_of = {}
+    for (cid, members, label) in groups:
+        heats = [H.nodes[n]["heat"] for n in members]
+        fcs = [H.nodes[n]["fc"] for n in members if "fc" in H.nodes[n]]
+        hottest = members[heats.index(max(heats))]
+        A.add_node(cid)
+        A.nodes[cid]["class"] = "cluster"
+        A.nodes[cid]["label"] = label if label else f"{node_label[hottest]} +{len(members) - 1}"
+        A.nodes[cid]["members"] = members
+        A.nodes[cid]["heat"] = sum(heats)
+        A.nodes[cid]["max_heat"] = max(heats)
+        if fcs:
+            A.nodes[cid]["fc"] = statistics.mean(fcs)
+        clusters[cid] = {"nodes": [node_data(H, n) for n in members], "edges": []}
+        for n in members:
+            cluster_of[n] = cid
+    for n in H.nodes:
+        if n not in cluster_of:
+            A.add_node(n, **H.nodes[n])
+    for (u, v) in H.edges:
+        a = cluster_of.get(u, u)
+        b = cluster_of.get(v, v)
+        for cid in set([cluster_of.get(u), cluster_of.get(v)]):
+            if cid:
+                clusters[cid]["edges"].append([u, v])
+        if a == b:
+            continue
+        if A.has_edge(a, b):
+            A.edges[a, b]["weight"] += 1
+        else:
+            A.add_edge(a, b, weight=1)
+    return (A, clusters, cluster_of)
+
+
+def write_view(fname, H, clusters=None, cluster_of=None, index_graph=None):
+    result_files.append(fname)
+    viz = open(fname, 'w')
+    print(heatwave_view.view_head, file=viz)
+    for n in H.nodes:
+        if H.nodes[n]["class"] == "cluster":
+            if "fc" in H.nodes[n]:
+                color = fc(H.nodes[n]["fc"])
+            else:
+                color = "#D3D3D3"
+            print(f"""
         {{
           data: {{
             id: "{n}",
-            label: "{node_label[n]}",
+            label: {json.dumps(H.nodes[n]["label"])},
             bg: "{color}",
-            url: "{link}{n}",
-            shape: "{shape}"
+            shape: "hexagon",
+            members: {len(H.nodes[n]["members"])},
+            heat: {H.nodes[n]["heat"]}
           }}
         }},
     """, file=viz)
-print("""
+            continue
+        d = node_data(H, n)
+        # NOTE: It is essential that nodel_labels _not_ contain double-quotes (")
+        print(f"""
+        {{
+          data: {{
+            id: "{d['id']}",
+            label: "{d['label']}",
+            bg: "{d['bg']}",
+            url: "{d['url']}",
+            shape: "{d['shape']}"
+          }}
+        }},
+    """, file=viz)
+    print("""
                       ],
                       edges: [
 """, file=viz)
 
-for edge in G.edges:
-    print(f"""
+    for edge in H.edges:
+        if "weight" in H.edges[edge]:
+            print(f"""
+    {{
+      data: {{
+        id: "{edge[0]}|{edge[1]}",
+        source: "{edge[0]}",
+        target: "{edge[1]}",
+        weight: {H.edges[edge]["weight"]}
+      }}
+    }}, 
+    """, file=viz)
+            continue
+        print(f"""
     {{
       data: {{
+        id: "{edge[0]}|{edge[1]}",
         source: "{edge[0]}",
         target: "{edge[1]}"
       }}
     }}, 
     """, file=viz)
 
-print("""
-                      ]
-                    }
-                });
-                cy.on('tap', 'node', function(){
-                    try { // your browser may block popups
-                        window.open( this.data('url') );
-                    } catch(e){ // fall back on url change
-                        window.location.href = this.data('url');
-                    }
-                }); 
-
-            });
-        </script>
-    </head>
-
-<body>
-    <div id="cy"></div>
-    <script type="text/javascript">
-    document.addEventListener(
-        "keydown",
-        (event) => {
-            const keyName = event.key;
-
-            if (keyName === "f") {
-                the_label = prompt("Node Label:");
-                var eles = cy.elements('node[label="' + the_label + '"]');
-                eles.select();
-                cy.center(eles);
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "e") {
-                cy.elements(":selected").neighborhood().select()
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "d") {
-                if (event.altKey) {
-                    cy.remove(cy.elements(":unselected"));
-                    cy.elements(":selected").unselect();
-                } else {
-                    cy.remove(cy.elements(":selected"));
-                }
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "Delete") {
-                if (event.altKey) {
-                    cy.remove(cy.elements(":unselected"));
-                    cy.elements(":selected").unselect();
-                } else {
-                    cy.remove(cy.elements(":selected"));
-                }
-                event.preventDefault();
-                return;
-            }
-
-
-            if (keyName === "D") {
-                cy.remove(cy.elements(":unselected"));
-                cy.elements(":selected").unselect();
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "l") {
-                cy.layout({
-                    name: 'cose',
-                    nodeOverlap: 1000,
-                    animate: false,
-                    // idealEdgeLength: 64,
-                    nodeDimensionsIncludeLabels: true,
-                }).run()
-                event.preventDefault();
-                return;
-            }
-
-
-            if (keyName === "c") {
-                if (event.altKey) {
-                    if (checkpoint) {
-                        cy.json(checkpoint);
-                    }
-                } else {
-                    checkpoint = cy.json()
-                    checkpoint.style = checkpoint_style;
-                }
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "C") {
-                if (checkpoint) {
-                    cy.json(checkpoint);
-                }
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "p") {
-                cy.pdf({ bg: '#FFF', save: true, full: true })
-            }
-
-
-            if (keyName === "s") {
-
-                const link = document.createElement("a");
-                const content = JSON.stringify(cy.json());
-                const file = new Blob([content], { type: 'application/json' });
-                link.href = URL.createObjectURL(file);
-                link.download = "network.json";
-                link.click();
-                URL.revokeObjectURL(link.href);
-            }
-
-            if (keyName === "n") {
-                alert('This network has ' + cy.nodes().length + ' nodes and ' + cy.edges().length + ' edges.')
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "h") {
-                alert('f = find\\ne = expand selection\\nd = delete selection\\ndelete-key = delete selection\\nalt-d = delete non-selected\\nshift-d = delete non-selected\\nalt-delete-key = delete non-selected\\nl = layout\\nc = checkpoint\\nalt-c = reset to checkpoint\\nshift-c = reset to checkpoint\\np = print to pdf\\ns = save to json_file\\ni = import json_file\\nn = show network stats\\nh = help')
-                event.preventDefault();
-                return;
-            }
-
-            if (keyName === "i") {
-                var input = document.createElement('input');
-                input.type = 'file';
-
-                input.onchange = e => {
-                    var file = e.target.files[0];
-                    var reader = new FileReader();
-                    reader.readAsText(file, 'UTF-8');
-
-                    reader.onload = readerEvent => {
-                        var content = readerEvent.target.result;
-
-                        checkpoint = JSON.parse(content);
-                        checkpoint.style = checkpoint_style;
-                        cy.json(checkpoint);
-                    }
-                }
-
-                input.click();
-            }
-        },
-        false,
-    );
-    </script>
-</body>
-
-</html>""", file=viz)
-
-    
-viz.close()
+    print(heatwave_view.view_script, file=viz)
+    print(heatwave_view.index_script % json.dumps(heatwave_view.view_index(index_graph if index_graph is not None else H, node_label)), file=viz)
+    if clusters is not None:
+        print(heatwave_view.cluster_script % (json.dumps(clusters), json.dumps(cluster_of)), file=viz)
+    print(heatwave_view.view_tail, file=viz)
+    viz.close()
+
+
+if aggregate_view:
+    (A, clusters, cluster_of) = aggregate_graph(G, aggregate_limit)
+    print(f"Aggregated View: {len(clusters)} clusters, {len(A.nodes)} nodes, {len(A.edges)} edges")
+    print("**********************")
+    write_view("heatwave.html", A, clusters, cluster_of, index_graph=G)
+    result_files.append("heatwave_clusters.tsv")
+    with open("heatwave_clusters.tsv", 'w') as out:
+        print("Cluster_ID\tMembers\tMetabolites\tOrthologs\tTotal_Heat\tMax_Heat\tMean_Log2FC\tMember_IDs", file=out)
+        for cid in clusters:
+            members = A.nodes[cid]["members"]
+            metabolites = sum(1 for n in members if G.nodes[n]["class"] == "metabolite")
+            mean_fc = A.nodes[cid].get("fc", "")
+            print(f"{cid}\t{len(members)}\t{metabolites}\t{len(members) - metabolites}\t{A.nodes[cid]['heat']}\t{A.nodes[cid]['max_heat']}\t{mean_fc}\t{','.join(members)}", file=out)
+else:
+    write_view("heatwave.html", G)
+
 
 ######################################################
 
 
-active = open(f"heatwave.tsv", 'w')
-print("Class\tNode_ID\tNode_Label\tLog2FC\tHeat", file=active)
-for n in G.nodes:
-    heat = ""
-    log2fc = ""
-    if "fc" in G.nodes[n]:
-        log2fc = f'{G.nodes[n]["fc"]}'
-    heat = f'{G.nodes[n]["heat"]}'
-    line = f"{G.nodes[n]['class']}\t{n}\t{node_label[n]}\t{log2fc}\t{heat}"
-    print(line, file=active)
-active.close()
+def write_table(fname, H):
+    result_files.append(fname)
+    active = open(fname, 'w')
+    print("Class\tNode_ID\tNode_Label\tLog2FC\tHeat", file=active)
+    for n in H.nodes:
+        heat = ""
+        log2fc = ""
+        if "fc" in H.nodes[n]:
+            log2fc = f'{H.nodes[n]["fc"]}'
+        heat = f'{H.nodes[n]["heat"]}'
+        line = f"{H.nodes[n]['class']}\t{n}\t{node_label[n]}\t{log2fc}\t{heat}"
+        print(line, file=active)
+    active.close()
+
+
+write_table("heatwave.tsv", G)
+remove_module_files()
+for (i, (module_score, M)) in enumerate(modules):
+    write_table(f"heatwave_module_{i + 1}.tsv", M)
+    write_view(f"heatwave_module_{i + 1}.html", M)
+
+if result_entry:
+    store_result(result_entry)
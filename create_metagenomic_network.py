@@ -6,262 +6,518 @@ import json
 import networkx as nx
 import random
 import numpy
+import tempfile
+import gzip
+import io
+import zipfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl  # not available on Windows, where only builders within one process are kept apart
+except ImportError:
+    fcntl = None
 
 
 VERBOSE = False
 
 allow_unmeasurable_reactions = False
 
+download_workers = 8  # resources downloaded (and parsed) concurrently
+
 random.seed(19700101)
 numpy.random.seed(19700101)
 
-if not os.path.isdir('data_cache'):
-    os.mkdir('data_cache')
+cache_dir = "data_cache"  # may be a directory shared by several builders (e.g. on a shared volume)
+if len(sys.argv) > 1:
+    cache_dir = sys.argv[1]
 
+network_file = "reaction_network.tsv"
+if len(sys.argv) > 2:
+    network_file = sys.argv[2]
 
-def cached_resource(prefix, url, error_message, suffix, cache_dir="data_cache"):
-    cache_fname = None
-    for fname in os.listdir(cache_dir):
-        if fname.startswith(prefix):
-            cache_fname = fname
-            break
-    if not cache_fname:
-        r = requests.get(url)
-        if r.status_code != 200:
-            print(error_message)
-            print(r.text)
-            sys.exit(-1)
-        else:
-            cache_fname = f"{prefix}_{round(time.time())}.{suffix}"
-            with open(os.path.join(cache_dir, cache_fname), 'w') as out:
-                print(r.text.strip(), file= out)
-    return os.path.join(cache_dir, cache_fname)
+kegg_url = "https://rest.kegg.jp"  # e.g. a local mock server when testing offline
+if len(sys.argv) > 3:
+    kegg_url = sys.argv[3]
+
+pubchem_url = "https://pubchem.ncbi.nlm.nih.gov/rest/pug"
+if len(sys.argv) > 4:
+    pubchem_url = sys.argv[4]
+
+os.makedirs(cache_dir, exist_ok=True)
 
 
 #
-# Get PubChem_Substances
+# data_cache may be shared by several builders running at once: files are written under a temporary (hidden) name and
+# renamed into place, so a reader never sees a partial file, and every fetch holds a per-key lock (within this process
+# and, through flock, across processes), so each resource is only downloaded once however many builders want it.
 #
 
-pubchem_substances = cached_resource(
-    "PubChem_Substances", 
-    "https://pubchem.ncbi.nlm.nih.gov/rest/pug/substance/sourceall/KEGG/xrefs/RegistryID/json",
-    "Failed to get KEGG-related substances from PubChem...",
-    "json")
+cache_locks = {}
+cache_locks_guard = threading.Lock()
 
-with open(pubchem_substances, 'r') as myfile:
-    data=myfile.read()
-obj = json.loads(data)
 
-sid_from_kegg = {}
-kegg_to_sid = {}
-for entry in obj['InformationList']['Information']:
-    assert entry["SID"] not in sid_from_kegg
-    sid_from_kegg[entry["SID"]] = set()
-    for kegg_id in entry["RegistryID"]:
-        if kegg_id.startswith("D"):
-            continue
-        sid_from_kegg[entry["SID"]].add(kegg_id)
-        assert kegg_id not in kegg_to_sid
-        kegg_to_sid[kegg_id] = entry["SID"]
+@contextlib.contextmanager
+def cache_lock(prefix, cache_dir=cache_dir):
+    with cache_locks_guard:
+        if prefix not in cache_locks:
+            cache_locks[prefix] = threading.Lock()
+    with cache_locks[prefix]:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(cache_dir, f".{prefix}.lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def find_cached(prefix, cache_dir=cache_dir):
+    for fname in os.listdir(cache_dir):
+        if fname.startswith(prefix):
+            return os.path.join(cache_dir, fname)
+    return None
+
+
+def write_cached(prefix, suffix, text, cache_dir=cache_dir):
+    # Resources are stored gzip-compressed (<prefix>_<time>.<suffix>.gz); open_cached() streams them back
+    (fd, tmp_fname) = tempfile.mkstemp(prefix=f".{prefix}_", suffix=".tmp", dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.open(raw, 'wt', compresslevel=6) as out:
+                print(text.strip(), file= out)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.chmod(tmp_fname, 0o644)  # mkstemp is owner-only, but the cache may be shared
+        cache_fname = os.path.join(cache_dir, f"{prefix}_{round(time.time())}.{suffix}.gz")
+        os.replace(tmp_fname, cache_fname)
+    except BaseException:  # also sys.exit(): never leave a partial temp file behind in the (shared) cache
+        remove_temp(tmp_fname)
+        raise
+    return cache_fname
+
+
+def remove_temp(tmp_fname):
+    try:
+        os.remove(tmp_fname)
+    except FileNotFoundError:
+        pass
+
+
+def open_cached(cache_fname):
+    # Caches written before compression was introduced are plain text
+    if cache_fname.endswith(".gz"):
+        return gzip.open(cache_fname, 'rt')
+    return open(cache_fname, 'r')
+
+
+def cached_resource(prefix, url, error_message, suffix, cache_dir=cache_dir):
+    cache_fname = find_cached(prefix, cache_dir)
+    if cache_fname:
+        return cache_fname
+    with cache_lock(prefix, cache_dir):
+        cache_fname = find_cached(prefix, cache_dir)  # fetched by another builder while we were waiting?
+        if not cache_fname:
+            r = requests.get(url)
+            if r.status_code != 200:
+                print(error_message)
+                print(r.text)
+                sys.exit(-1)
+            else:
+                cache_fname = write_cached(prefix, suffix, r.text, cache_dir)
+    return cache_fname
 
-for sid in sid_from_kegg:
-    assert len(sid_from_kegg[sid]) < 2
 
 #
-# Get PubChem_InChIKeys (not using cached_resource() only because of the two-phase, listkey-based API)
+# Small per-entry resources (tens of thousands of "get/CXXXXX" KEGG entries) are packed into compressed zip segments,
+# one per batch of downloads, instead of one file each; like other cache files, a segment is renamed into place once
+# complete. Entries cached as single files by older builds are still used.
 #
 
-pubchem_inchikeys = None
-for fname in os.listdir("data_cache"):
-    if fname.startswith("PubChem_InChIKeys_"):
-        pubchem_inchikeys = os.path.join("data_cache", fname)
-        break
-if not pubchem_inchikeys:
-    r = requests.get("https://pubchem.ncbi.nlm.nih.gov/rest/pug/substance/sourceall/KEGG/cids/json?list_return=listkey")
-    if r.status_code != 200:
-        print("Failed to generate listkey or KEGG-related CIDS from PubChem...")
-        print(r.text)
-        sys.exit(-1)
-    else:
-        listkey = json.loads(r.text)["IdentifierList"]["ListKey"]
-        r = requests.get(f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/listkey/{listkey}/property/inchikey/json")
-        if r.status_code != 200:
-            print("Failed to retrieve data associated with listkey:", listkey)
-            print(r.text)
-            sys.exit(-1)
-        else:
-            pubchem_inchikeys = os.path.join("data_cache", f"PubChem_InChIKeys_{round(time.time())}.json")
-            with open(pubchem_inchikeys, 'w') as out:
-                print(r.text.strip(), file= out)
+def find_cached_entries(prefix, entries, cache_dir=cache_dir):
+    found = {}
+    for fname in sorted(os.listdir(cache_dir)):
+        if fname.startswith(prefix + "_") and fname.endswith(".zip"):
+            with zipfile.ZipFile(os.path.join(cache_dir, fname)) as segment:
+                for member in segment.namelist():
+                    entry = member.rsplit(".", 1)[0]
+                    if entry in entries:
+                        found[entry] = (os.path.join(cache_dir, fname), member)
+    for entry in entries:
+        if entry not in found:
+            cache_fname = find_cached(entry + "_", cache_dir)
+            if cache_fname:
+                found[entry] = (cache_fname, None)
+    return found
+
+
+def cached_entries(prefix, entries, url, error_message, suffix, cache_dir=cache_dir):
+    # url and error_message are format strings for a single entry; returns {entry: (segment or file, zip member or None)}
+    found = find_cached_entries(prefix, entries, cache_dir)
+    if len(found) == len(entries):
+        return found
+    with cache_lock(prefix, cache_dir):
+        found = find_cached_entries(prefix, entries, cache_dir)  # fetched by another builder while we were waiting?
+        missing = sorted(set(entries) - set(found))
+        if missing:
+            downloads = [pool.submit(requests.get, url.format(entry)) for entry in missing]
+            (fd, tmp_fname) = tempfile.mkstemp(prefix=f".{prefix}_", suffix=".tmp", dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as raw:
+                    with zipfile.ZipFile(raw, 'w', compression=zipfile.ZIP_DEFLATED) as segment:
+                        for (entry, download) in zip(missing, downloads):
+                            r = download.result()
+                            if r.status_code != 200:
+                                print(error_message.format(entry))
+                                print(r.text)
+                                sys.exit(-1)
+                            segment.writestr(f"{entry}.{suffix}", r.text.strip() + "\n")
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                os.chmod(tmp_fname, 0o644)
+                segment_fname = os.path.join(cache_dir, f"{prefix}_{round(time.time())}_{os.getpid()}.zip")
+                os.replace(tmp_fname, segment_fname)
+            except BaseException:  # a failed download or write: drop the partial segment
+                remove_temp(tmp_fname)
+                raise
+            for entry in missing:
+                found[entry] = (segment_fname, f"{entry}.{suffix}")
+    return found
+
+
+@contextlib.contextmanager
+def open_cached_entry(location, segments):
+    # segments ({segment file name: ZipFile}) keeps every segment open once it has been used, so its central
+    # directory is only read once however many of its entries are needed; the caller closes them afterwards
+    (fname, member) = location
+    if member is None:
+        with open_cached(fname) as f:
+            yield f
+        return
+    if fname not in segments:
+        segments[fname] = zipfile.ZipFile(fname)
+    with io.TextIOWrapper(segments[fname].open(member), encoding="utf-8") as f:
+        yield f
 
-cid_to_inchikey = {}
-with open(pubchem_inchikeys, 'r') as myfile:
-    data=myfile.read()
-obj = json.loads(data)
 
-for entry in obj['PropertyTable']['Properties']:
-    assert "CID" in entry.keys()
-    cid = entry["CID"]
-    assert cid not in cid_to_inchikey
-    cid_to_inchikey[cid] = entry["InChIKey"][:14]  # only the core graph...
+#
+# The build is a staged pipeline: every resource below is downloaded (or read from the cache) and parsed by its own
+# task on a thread pool, so downloads overlap one another and each resource is parsed as soon as it arrives. The
+# main thread only waits for the results it needs next (a task calling sys.exit() ends the build when its result is
+# asked for).
+#
 
 #
-# Get PubChem_SID_CID
+# Get PubChem_Substances
+#
+
+def get_pubchem_substances():
+    pubchem_substances = cached_resource(
+        "PubChem_Substances",
+        f"{pubchem_url}/substance/sourceall/KEGG/xrefs/RegistryID/json",
+        "Failed to get KEGG-related substances from PubChem...",
+        "json")
+
+    with open_cached(pubchem_substances) as myfile:
+        obj = json.load(myfile)
+
+    sid_from_kegg = {}
+    kegg_to_sid = {}
+    for entry in obj['InformationList']['Information']:
+        assert entry["SID"] not in sid_from_kegg
+        sid_from_kegg[entry["SID"]] = set()
+        for kegg_id in entry["RegistryID"]:
+            if kegg_id.startswith("D"):
+                continue
+            sid_from_kegg[entry["SID"]].add(kegg_id)
+            assert kegg_id not in kegg_to_sid
+            kegg_to_sid[kegg_id] = entry["SID"]
+
+    for sid in sid_from_kegg:
+        assert len(sid_from_kegg[sid]) < 2
+    return kegg_to_sid
+
+#
+# Get PubChem_InChIKeys (not using cached_resource() only because of the two-phase, listkey-based API)
 #
 
-pubchem_substance_to_compound = cached_resource(
-    "PubChem_SID_CID", 
-    "https://pubchem.ncbi.nlm.nih.gov/rest/pug/substance/sourceall/KEGG/cids/json",
-    "Failed to get KEGG-related substance_compound information from PubChem...",
-    "json")
+def get_pubchem_inchikeys():
+    pubchem_inchikeys = find_cached("PubChem_InChIKeys_")
+    if not pubchem_inchikeys:
+        with cache_lock("PubChem_InChIKeys_"):
+            pubchem_inchikeys = find_cached("PubChem_InChIKeys_")
+            if not pubchem_inchikeys:
+                r = requests.get(f"{pubchem_url}/substance/sourceall/KEGG/cids/json?list_return=listkey")
+                if r.status_code != 200:
+                    print("Failed to generate listkey or KEGG-related CIDS from PubChem...")
+                    print(r.text)
+                    sys.exit(-1)
+                else:
+                    listkey = json.loads(r.text)["IdentifierList"]["ListKey"]
+                    r = requests.get(f"{pubchem_url}/compound/listkey/{listkey}/property/inchikey/json")
+                    if r.status_code != 200:
+                        print("Failed to retrieve data associated with listkey:", listkey)
+                        print(r.text)
+                        sys.exit(-1)
+                    else:
+                        pubchem_inchikeys = write_cached("PubChem_InChIKeys", "json", r.text)
 
-cid_from_sid_from_kegg = {}
-sid_to_cid = {}
-with open(pubchem_substance_to_compound, 'r') as myfile:
-    data=myfile.read()
-obj = json.loads(data)
+    cid_to_inchikey = {}
+    with open_cached(pubchem_inchikeys) as myfile:
+        obj = json.load(myfile)
 
-for entry in obj['InformationList']['Information']:
-    if "CID" in entry.keys():
-        assert len(entry["CID"]) == 1
-        cid = entry["CID"][0]
-        sid = entry["SID"]
-        sid_to_cid[sid] = cid
-        if cid not in cid_from_sid_from_kegg:
-            cid_from_sid_from_kegg[cid] = set()
-        cid_from_sid_from_kegg[cid].add(sid)
+    for entry in obj['PropertyTable']['Properties']:
+        assert "CID" in entry.keys()
+        cid = entry["CID"]
+        assert cid not in cid_to_inchikey
+        cid_to_inchikey[cid] = entry["InChIKey"][:14]  # only the core graph...
+    return cid_to_inchikey
 
 #
-# Create KEGG_to_InChIK_table
+# Get PubChem_SID_CID
 #
 
-kegg_to_inchik = {}
-for k in kegg_to_sid:
-    s = kegg_to_sid[k]
-    if s in sid_to_cid:
-        c = sid_to_cid[s]
-        inchik = cid_to_inchikey[c]
-        kegg_to_inchik[k] = inchik
+def get_pubchem_sid_cid():
+    pubchem_substance_to_compound = cached_resource(
+        "PubChem_SID_CID",
+        f"{pubchem_url}/substance/sourceall/KEGG/cids/json",
+        "Failed to get KEGG-related substance_compound information from PubChem...",
+        "json")
+
+    sid_to_cid = {}
+    with open_cached(pubchem_substance_to_compound) as myfile:
+        obj = json.load(myfile)
+
+    for entry in obj['InformationList']['Information']:
+        if "CID" in entry.keys():
+            assert len(entry["CID"]) == 1
+            cid = entry["CID"][0]
+            sid = entry["SID"]
+            sid_to_cid[sid] = cid
+    return sid_to_cid
 
 #
 # Get KEGG compound names from KEGG
 #
 
-kegg_compounds = cached_resource(
-    "KEGG_compounds", 
-    "https://rest.kegg.jp/list/compound",
-    "Failed to get KEGG compound names...",
-    "tsv")
+def get_kegg_compounds():
+    kegg_compounds = cached_resource(
+        "KEGG_compounds",
+        f"{kegg_url}/list/compound",
+        "Failed to get KEGG compound names...",
+        "tsv")
+
+    compounds = {}
+    compound_choices = {}
+    with open_cached(kegg_compounds) as f:
+        for line in f:
+            # "C00018\tPyridoxal phosphate; Pyridoxal 5'-phosphate; Pyridoxal 5-phosphate; PLP"
+            (cname, names) = line.strip().split("\t")
+            if ";" in names:
+                name = names.split(";")[0]
+            else:
+                name = names
+            if name in compounds:
+                if name not in compound_choices:  # This means there is more than one KEGG compound for the same name which _can_ happen!!!
+                    compound_choices[name] = set([compounds[name]])
+                compound_choices[name].add(cname)
+            compounds[name] = cname
+    return (compounds, compound_choices)
 
 #
-# Find best compound per compound name (compound with the most reactions)
+# Count the reactions of a candidate compound (to pick the best compound per compound name)
 #
 
-compounds = {}
-compound_choices = {}
-with open(kegg_compounds) as f:
+def count_compound_reactions(f):
+    in_reactions = False
+    rcount = 0
     for line in f:
-        # "C00018\tPyridoxal phosphate; Pyridoxal 5'-phosphate; Pyridoxal 5-phosphate; PLP"
-        (cname, names) = line.strip().split("\t")
-        if ";" in names:
-            name = names.split(";")[0]
+        if in_reactions:
+            if line[0] != " ":
+                in_reactions = False
+                continue
+            else:
+                rcount += len(line.strip().split())
         else:
-            name = names
-        if name in compounds:
-            if name not in compound_choices:  # This means there is more than one KEGG compound for the same name which _can_ happen!!!
-                compound_choices[name] = set([compounds[name]])
-            compound_choices[name].add(cname)
-        compounds[name] = cname
+            if line.startswith("REACTION"):
+                rcount += len(line.split()[1:])
+    return rcount
 
-for name in compound_choices:
-    best_rcount = -1
-    for cname in sorted(compound_choices[name]):
-        #
-        # Get information about candidate cname for compound name...
-        #
-        cname_file = cached_resource(
-            cname,
-            "https://rest.kegg.jp/get/" + cname,
-            f"Failed to get info about {cname}...",
-            "txt")
-        with open(cname_file) as f:                
-            in_reactions = False
-            rcount = 0
-            for line in f:
-                if in_reactions:
-                    if line[0] != " ":
-                        in_reactions = False
-                        continue
-                    else:
-                        rcount += len(line.strip().split())
-                else:
-                    if line.startswith("REACTION"):
-                        rcount += len(line.split()[1:])
-            if rcount > best_rcount:
-                best_rcount = rcount
-                compounds[name] = cname
+#
+# Get KEGG reaction-to-ortholog list
+#
 
+def get_reaction_to_ortho():
+    kegg_reaction_to_ortho = cached_resource(
+        "KEGG_rn_to_ko",
+        f"{kegg_url}/link/ko/rn",
+        "Failed to get KEGG reaction-to-ortholog list...",
+        "tsv")
+
+    reaction_to_ortho = {}
+    with open_cached(kegg_reaction_to_ortho) as f:
+        for line in f:
+            vals = line.strip().split("\t")
+            reaction = vals[0][3:]
+            ortholog = vals[1][3:]
+            if reaction not in reaction_to_ortho:
+                reaction_to_ortho[reaction] = set()
+            reaction_to_ortho[reaction].add(ortholog)
+    return reaction_to_ortho
 
 #
-# Get KEGG reaction-to-ortholog list
+# Get KEGG glycan names from KEGG  <-- sometimes they are referenced by name in reactions rather than as GXXXXX
 #
 
-kegg_reaction_to_ortho = cached_resource(
-    "KEGG_rn_to_ko", 
-    "https://rest.kegg.jp/link/ko/rn",
-    "Failed to get KEGG reaction-to-ortholog list...",
-    "tsv")
+def get_glycan_names():
+    kegg_glycans = cached_resource(
+        "KEGG_glycans",
+        f"{kegg_url}/list/gl",
+        "Failed to get KEGG glycan names...",
+        "tsv")
+
+    glycan_names = []
+    with open_cached(kegg_glycans) as f:
+        for line in f:
+            # "G00001   N-Acetyl-D-glucosaminyldiphosphodolichol; (GlcNAc)1 (PP-Dol)"
+            (glname, names) = line.strip().split("\t")
+            if ";" in names:
+                name = names.split(";")[0]
+            else:
+                name = names
+            glycan_names.append((name, glname))
+    return glycan_names
 
-reaction_to_ortho = {}
-with open(kegg_reaction_to_ortho) as f:
-    for line in f:
-        vals = line.strip().split("\t")
-        reaction = vals[0][3:]
-        ortholog = vals[1][3:]
-        if reaction not in reaction_to_ortho:
-            reaction_to_ortho[reaction] = set()
-        reaction_to_ortho[reaction].add(ortholog)
+#
+# Get KEGG reactions
+#
 
-reactions = list(reaction_to_ortho.keys())
+def get_kegg_reactions():
+    kegg_reactions = cached_resource(
+        "KEGG_reactions",
+        f"{kegg_url}/list/rn",
+        "Failed to get KEGG reactions...",
+        "tsv")
+
+    reaction_details = []
+    with open_cached(kegg_reactions) as f:
+        for line in f:
+            # "R00001\tpolyphosphate polyphosphohydrolase; Polyphosphate + n H2O <=> (n+1) Oligophosphate"
+            (rname, details) = line.strip().split("\t")
+            reaction_details.append((rname, details))
+    return reaction_details
 
 #
-# Get KEGG glycan names from KEGG  <-- sometimes they are referenced by name in reactions rather than as GXXXXX
+# Get KEGG pathway and module names and memberships of orthologs and compounds (used to tag nodes/edges and to shard the network)
+#
+
+def get_pathway_names():
+    pathway_names = {}
+    for (prefix, url, error_message) in [
+            ("KEGG_pathways", f"{kegg_url}/list/pathway", "Failed to get KEGG pathway names..."),
+            ("KEGG_modules", f"{kegg_url}/list/module", "Failed to get KEGG module names...")]:
+        with open_cached(cached_resource(prefix, url, error_message, "tsv")) as f:
+            for line in f:
+                # "map00010\tGlycolysis / Gluconeogenesis" or "M00001\tGlycolysis (Embden-Meyerhof pathway), glucose => pyruvate"
+                (pathway, name) = line.strip().split("\t")
+                pathway_names[pathway.split(":")[-1]] = name
+    return pathway_names
+
+
+def get_memberships(prefix, url, error_message):
+    memberships = {}
+    with open_cached(cached_resource(prefix, url, error_message, "tsv")) as f:
+        for line in f:
+            # "ko:K00001\tpath:map00010" or "cpd:C00022\tmd:M00001"
+            vals = line.strip().split("\t")
+            entry = vals[0].split(":")[1]
+            pathway = vals[1].split(":")[1]
+            if pathway.startswith("ko"):  # link/pathway lists every map twice (as mapXXXXX and koXXXXX)
+                continue
+            if entry not in memberships:
+                memberships[entry] = set()
+            memberships[entry].add(pathway)
+    return memberships
+
+
+pool = ThreadPoolExecutor(max_workers=download_workers)
+
+# Submitted roughly largest first, so that the big PubChem dumps start downloading right away
+kegg_to_sid_task = pool.submit(get_pubchem_substances)
+cid_to_inchikey_task = pool.submit(get_pubchem_inchikeys)
+sid_to_cid_task = pool.submit(get_pubchem_sid_cid)
+compounds_task = pool.submit(get_kegg_compounds)
+reaction_to_ortho_task = pool.submit(get_reaction_to_ortho)
+glycan_names_task = pool.submit(get_glycan_names)
+reaction_details_task = pool.submit(get_kegg_reactions)
+pathway_names_task = pool.submit(get_pathway_names)
+membership_tasks = [pool.submit(get_memberships, prefix, url, error_message) for (prefix, url, error_message) in [
+    ("KEGG_ko_to_pathway", f"{kegg_url}/link/pathway/ko", "Failed to get KEGG ortholog-to-pathway list..."),
+    ("KEGG_compound_to_pathway", f"{kegg_url}/link/pathway/compound", "Failed to get KEGG compound-to-pathway list..."),
+    ("KEGG_ko_to_module", f"{kegg_url}/link/module/ko", "Failed to get KEGG ortholog-to-module list..."),
+    ("KEGG_compound_to_module", f"{kegg_url}/link/module/compound", "Failed to get KEGG compound-to-module list...")]]
+
+#
+# Find best compound per compound name (compound with the most reactions); the candidates are fetched
+# concurrently while the PubChem resources are still being downloaded
 #
 
-kegg_glycans = cached_resource(
-    "KEGG_glycans", 
-    "https://rest.kegg.jp/list/gl",
-    "Failed to get KEGG glycan names...",
-    "tsv")
+(compounds, compound_choices) = compounds_task.result()
+
+candidates = set()
+for name in compound_choices:
+    candidates |= compound_choices[name]
+candidate_entries = cached_entries(
+    "KEGG_entries",
+    candidates,
+    f"{kegg_url}/get/{{}}",
+    "Failed to get info about {}...",
+    "txt")
+
+segments = {}
+for name in compound_choices:
+    best_rcount = -1
+    for cname in sorted(compound_choices[name]):
+        with open_cached_entry(candidate_entries[cname], segments) as f:
+            rcount = count_compound_reactions(f)
+        if rcount > best_rcount:
+            best_rcount = rcount
+            compounds[name] = cname
+for segment in segments.values():
+    segment.close()
 
 glycans = {}
-with open(kegg_glycans) as f:
-    for line in f:
-        # "G00001   N-Acetyl-D-glucosaminyldiphosphodolichol; (GlcNAc)1 (PP-Dol)"
-        (glname, names) = line.strip().split("\t")
-        if ";" in names:
-            name = names.split(";")[0]
-        else:
-            name = names
-        if name in glycans:
-            if VERBOSE:
-                print("Note: recurring glycan name (linear representation of tree will do this)...", name, glycans[name], glname)
-            continue
-        if name in compounds:
-            if VERBOSE:
-                print("Warning: name shared by glycans and compounds!!!", name, compounds[name], glname)
-            continue  # we will assume that if a reaction references this name we can use the compound rather than the glycan
-        glycans[name] = glname
+for (name, glname) in glycan_names_task.result():
+    if name in glycans:
+        if VERBOSE:
+            print("Note: recurring glycan name (linear representation of tree will do this)...", name, glycans[name], glname)
+        continue
+    if name in compounds:
+        if VERBOSE:
+            print("Warning: name shared by glycans and compounds!!!", name, compounds[name], glname)
+        continue  # we will assume that if a reaction references this name we can use the compound rather than the glycan
+    glycans[name] = glname
 
 #
-# Get KEGG reactions
+# Create KEGG_to_InChIK_table
 #
 
-kegg_reactions = cached_resource(
-    "KEGG_reactions", 
-    "https://rest.kegg.jp/list/rn",
-    "Failed to get KEGG reactions...",
-    "tsv")
+kegg_to_sid = kegg_to_sid_task.result()
+sid_to_cid = sid_to_cid_task.result()
+cid_to_inchikey = cid_to_inchikey_task.result()
+
+kegg_to_inchik = {}
+for k in kegg_to_sid:
+    s = kegg_to_sid[k]
+    if s in sid_to_cid:
+        c = sid_to_cid[s]
+        inchik = cid_to_inchikey[c]
+        kegg_to_inchik[k] = inchik
+
+reaction_to_ortho = reaction_to_ortho_task.result()
+reactions = set(reaction_to_ortho.keys())
 
 
 def parse_reaction_side(reaction_side):
@@ -329,37 +585,33 @@ def parse_reaction_side(reaction_side):
 inchik_left = {}
 inchik_right = {}
 
-with open(kegg_reactions) as f:
-    for line in f:
-        # "R00001\tpolyphosphate polyphosphohydrolase; Polyphosphate + n H2O <=> (n+1) Oligophosphate"
-        (rname, details) = line.strip().split("\t")
-
-        if rname not in reactions:
-            if allow_unmeasurable_reactions:
-                reactions.add(rname)
-            else:
-                continue
-
-        if ";" in details:
-            last_semicolon = details.rfind(";")
-            name = details[:last_semicolon]
-            reaction = details[(last_semicolon + 2):]  # The +1 is because of a space character after the semicolon
+for (rname, details) in reaction_details_task.result():
+    if rname not in reactions:
+        if allow_unmeasurable_reactions:
+            reactions.add(rname)
         else:
-            reaction = details
-        (left, right) = reaction.split(" <=> ")
+            continue
 
-        left_inchiks = parse_reaction_side(left)
-        right_inchiks = parse_reaction_side(right)
+    if ";" in details:
+        last_semicolon = details.rfind(";")
+        name = details[:last_semicolon]
+        reaction = details[(last_semicolon + 2):]  # The +1 is because of a space character after the semicolon
+    else:
+        reaction = details
+    (left, right) = reaction.split(" <=> ")
+
+    left_inchiks = parse_reaction_side(left)
+    right_inchiks = parse_reaction_side(right)
 
-        for inchik in left_inchiks:
-            if rname not in inchik_left:
-                inchik_left[rname] = set()
-            inchik_left[rname].add(inchik)
+    for inchik in left_inchiks:
+        if rname not in inchik_left:
+            inchik_left[rname] = set()
+        inchik_left[rname].add(inchik)
 
-        for inchik in right_inchiks:
-            if rname not in inchik_right:
-                inchik_right[rname] = set()
-            inchik_right[rname].add(inchik)
+    for inchik in right_inchiks:
+        if rname not in inchik_right:
+            inchik_right[rname] = set()
+        inchik_right[rname].add(inchik)
 
 sorted_reactions = sorted(reactions)
 
@@ -394,10 +646,79 @@ for reaction in sorted_reactions:
 
 U = G.to_undirected()
 
-with open(f"reaction_network.tsv", 'w') as out:
-    # print("EntryType\tNode_ID_or_From_ID\tNode_Label_or_To_ID", file=out)
+#
+# Tag nodes with their KEGG pathway and module memberships
+#
+
+pathway_names = pathway_names_task.result()
+kegg_memberships = {}
+for task in membership_tasks:
+    memberships = task.result()
+    for entry in memberships:
+        if entry not in kegg_memberships:
+            kegg_memberships[entry] = set()
+        kegg_memberships[entry] |= memberships[entry]
+
+node_memberships = {}
+for n in U.nodes:
+    node_memberships[n] = set()
+    if U.nodes[n]['class'] == "reaction":
+        node_memberships[n] |= kegg_memberships.get(n, set())
+for k in kegg_to_inchik:
+    inchik = kegg_to_inchik[k]
+    if inchik in node_memberships:  # several KEGG compounds can share the same InChIK core
+        node_memberships[inchik] |= kegg_memberships.get(k, set())
+
+# An edge belongs to a pathway/module when both of its ends do
+edge_memberships = {}
+for (a, b) in U.edges:
+    edge_memberships[(a, b)] = node_memberships[a] & node_memberships[b]
+
+
+def membership_column(pathways):
+    if not pathways:
+        return ""
+    return "\t" + ",".join(sorted(pathways))
+
+
+with open(network_file, 'w') as out:
+    # print("EntryType\tNode_ID_or_From_ID\tNode_Label_or_To_ID\tPathways", file=out)
     for n in U.nodes:
-        line = f"node\t{U.nodes[n]['class']}\t{n}"
+        line = f"node\t{U.nodes[n]['class']}\t{n}{membership_column(node_memberships[n])}"
         print(line, file=out)
     for (a, b) in U.edges:
-        print(f"edge\t{a}\t{b}", file=out)
+        print(f"edge\t{a}\t{b}{membership_column(edge_memberships[(a, b)])}", file=out)
+
+#
+# Write one shard per pathway/module (its nodes and every edge with at least one end among them, in the same
+# format) plus an index, so that analyze_metagenomic_data.py can load only the subnetwork of the pathways of
+# interest: the union of the selected shards holds every edge between two of their nodes, also across pathways
+#
+
+shard_dir = os.path.splitext(network_file)[0] + "_shards"
+os.makedirs(shard_dir, exist_ok=True)
+
+shard_nodes = {}
+shard_edges = {}
+for n in U.nodes:
+    for pathway in node_memberships[n]:
+        if pathway not in shard_nodes:
+            shard_nodes[pathway] = []
+            shard_edges[pathway] = []
+        shard_nodes[pathway].append(n)
+for (a, b) in U.edges:
+    for pathway in sorted(node_memberships[a] | node_memberships[b]):
+        shard_edges[pathway].append((a, b))
+
+with open(os.path.join(shard_dir, "index.tsv"), 'w') as index:
+    print("Pathway_ID\tName\tShard\tNodes\tEdges", file=index)
+    for pathway in sorted(shard_nodes):
+        shard = f"{pathway}.tsv"
+        with open(os.path.join(shard_dir, shard), 'w') as out:
+            for n in shard_nodes[pathway]:
+                print(f"node\t{U.nodes[n]['class']}\t{n}", file=out)
+            for (a, b) in shard_edges[pathway]:
+                print(f"edge\t{a}\t{b}", file=out)
+        print(f"{pathway}\t{pathway_names.get(pathway, '')}\t{shard}\t{len(shard_nodes[pathway])}\t{len(shard_edges[pathway])}", file=index)
+
+pool.shutdown()
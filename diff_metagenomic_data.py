@@ -0,0 +1,304 @@
+import sys
+import json
+import numpy
+import networkx as nx
+import heatwave_view
+
+#
+# Compares two projections (the heatwave.tsv files of two runs) or two network builds (two reaction_network.tsv files):
+#
+#   python diff_metagenomic_data.py old/heatwave.tsv new/heatwave.tsv [reaction_network.tsv] [new_reaction_network.tsv]
+#   python diff_metagenomic_data.py old_reaction_network.tsv new_reaction_network.tsv
+#
+# Both sides are interned into one sorted vocabulary of node IDs, so nodes become integer codes and edges
+# source * vocabulary size + target codes, and added/removed/changed nodes and edges as well as heat deltas
+# follow from a few array operations.  The changes are written to heatwave_diff.tsv and, highlighted in the
+# combined network of both sides, to heatwave_diff.html.
+#
+
+if len(sys.argv) < 3:
+    print("Usage: python diff_metagenomic_data.py old_file new_file [network_file] [new_network_file] [min_heat_delta] [hot_color] [cold_color] [view_limit]")
+    sys.exit(-1)
+old_file = sys.argv[1]
+new_file = sys.argv[2]
+
+network_file = "reaction_network.tsv"  # the edges of a projection are the network edges between its nodes
+if len(sys.argv) > 3 and sys.argv[3] != "None":
+    network_file = sys.argv[3]
+
+new_network_file = network_file  # e.g. when the two runs were made on different network releases
+if len(sys.argv) > 4 and sys.argv[4] != "None":
+    new_network_file = sys.argv[4]
+
+min_heat_delta = 0.0  # nodes of both runs whose heat differs by no more than this (and agree otherwise) are unchanged
+if len(sys.argv) > 5:
+    min_heat_delta = float(sys.argv[5])
+
+hot_color = "#73FDFF"
+if len(sys.argv) > 6:
+    hot_color = sys.argv[6]
+
+cold_color = "#FF7E79"
+if len(sys.argv) > 7:
+    cold_color = sys.argv[7]
+
+view_limit = 2000  # larger diffs only show this many nodes with changes or changed edges in heatwave_diff.html
+if len(sys.argv) > 8:
+    view_limit = int(sys.argv[8])
+
+
+def first_rows(ids):
+    # indices of the first row of every ID, in file order (as the analysis, later duplicates are ignored)
+    (uniq, first) = numpy.unique(ids, return_index=True)
+    return numpy.sort(first)
+
+
+def load_network(fname):
+    nodes = []
+    edges = []
+    with open(fname, 'r') as myfile:
+        for line in myfile:
+            vals = line.strip().split("\t")
+            if vals[0] == "node":
+                nodes.append((vals[2], vals[1], vals[3] if len(vals) > 3 else ""))
+            if vals[0] == "edge":
+                edges.append((vals[1], vals[2], vals[3] if len(vals) > 3 else ""))
+    nodes = numpy.array(nodes, dtype=object).reshape(-1, 3)
+    edges = numpy.array(edges, dtype=object).reshape(-1, 3)
+    nodes = nodes[first_rows(nodes[:, 0].astype(str))]
+    return {
+        "ids": nodes[:, 0].astype(str),
+        "class": nodes[:, 1],
+        "label": nodes[:, 0],
+        "fc": numpy.full(len(nodes), numpy.nan),
+        "heat": numpy.full(len(nodes), numpy.nan),
+        "pathways": nodes[:, 2],
+        "source": edges[:, 0].astype(str),
+        "target": edges[:, 1].astype(str),
+        "edge_pathways": edges[:, 2]}
+
+
+def load_projection(fname, network):
+    # heatwave.tsv (Class, Node_ID, Node_Label, Log2FC, Heat); edges and pathways come from the network file
+    table = numpy.loadtxt(fname, delimiter="\t", dtype=str, comments=None, ndmin=2, skiprows=1, usecols=(0, 1, 2, 3, 4)).reshape(-1, 5)
+    table = table[first_rows(table[:, 1])]
+    ids = table[:, 1]
+    in_network = numpy.isin(network["ids"], ids)
+    pathways = dict(zip(network["ids"][in_network], network["pathways"][in_network]))
+    keep = numpy.isin(network["source"], ids) & numpy.isin(network["target"], ids)
+    return {
+        "ids": ids,
+        "class": table[:, 0].astype(object),
+        "label": table[:, 2].astype(object),
+        "fc": numpy.where(table[:, 3] == "", "nan", table[:, 3]).astype(float),
+        "heat": table[:, 4].astype(float),
+        "pathways": numpy.array([pathways.get(n, "") for n in ids], dtype=object),
+        "source": network["source"][keep],
+        "target": network["target"][keep],
+        "edge_pathways": numpy.full(int(numpy.count_nonzero(keep)), "", dtype=object)}
+
+
+def is_projection(fname):
+    with open(fname, 'r') as myfile:
+        return myfile.readline().startswith("Class\tNode_ID")
+
+
+if is_projection(old_file) != is_projection(new_file):
+    print(f"Cannot compare a projection with a network ({old_file}, {new_file})")
+    sys.exit(-1)
+if is_projection(old_file):
+    networks = {fname: load_network(fname) for fname in set([network_file, new_network_file])}
+    old = load_projection(old_file, networks[network_file])
+    new = load_projection(new_file, networks[new_network_file])
+else:
+    old = load_network(old_file)
+    new = load_network(new_file)
+
+vocab = numpy.unique(numpy.concatenate([old["ids"], new["ids"], old["source"], old["target"], new["source"], new["target"]]))
+V = len(vocab)
+
+
+def node_columns(side):
+    # per-vocabulary-code arrays (absent nodes: False, NaN or "")
+    codes = numpy.searchsorted(vocab, side["ids"])
+    present = numpy.zeros(V, dtype=bool)
+    present[codes] = True
+    columns = {"present": present}
+    for key in ["fc", "heat"]:
+        columns[key] = numpy.full(V, numpy.nan)
+        columns[key][codes] = side[key]
+    for key in ["class", "label", "pathways"]:
+        columns[key] = numpy.full(V, "", dtype=object)
+        columns[key][codes] = side[key]
+    return columns
+
+
+def edge_keys(side):
+    # sorted unique source * V + target codes, with the pathways of each
+    keys = numpy.searchsorted(vocab, side["source"]).astype(numpy.int64) * V + numpy.searchsorted(vocab, side["target"])
+    (keys, first) = numpy.unique(keys, return_index=True)
+    return (keys, side["edge_pathways"][first])
+
+
+o = node_columns(old)
+n = node_columns(new)
+both = o["present"] & n["present"]
+heat_delta = n["heat"] - o["heat"]
+fc_differs = ~((o["fc"] == n["fc"]) | (numpy.isnan(o["fc"]) & numpy.isnan(n["fc"])))
+node_change = numpy.full(V, "", dtype=object)
+node_change[n["present"] & ~o["present"]] = "added"
+node_change[o["present"] & ~n["present"]] = "removed"
+changed_nodes = both & ((numpy.abs(heat_delta) > min_heat_delta) | fc_differs | (o["class"] != n["class"]) | (o["label"] != n["label"]) | (o["pathways"] != n["pathways"]))
+node_change[changed_nodes] = "changed"
+
+(old_keys, old_edge_pathways) = edge_keys(old)
+(new_keys, new_edge_pathways) = edge_keys(new)
+(common_keys, old_common, new_common) = numpy.intersect1d(old_keys, new_keys, assume_unique=True, return_indices=True)
+edge_keys_all = numpy.union1d(old_keys, new_keys)
+in_old = numpy.isin(edge_keys_all, old_keys, assume_unique=True)
+in_new = numpy.isin(edge_keys_all, new_keys, assume_unique=True)
+edge_change = numpy.full(len(edge_keys_all), "", dtype=object)
+edge_change[in_new & ~in_old] = "added"
+edge_change[in_old & ~in_new] = "removed"
+changed_edge_keys = common_keys[old_edge_pathways[old_common] != new_edge_pathways[new_common]]
+edge_change[numpy.isin(edge_keys_all, changed_edge_keys, assume_unique=True)] = "changed"
+edge_source = edge_keys_all // V
+edge_target = edge_keys_all % V
+edge_old_pathways = numpy.full(len(edge_keys_all), "", dtype=object)
+edge_old_pathways[numpy.searchsorted(edge_keys_all, old_keys)] = old_edge_pathways
+edge_new_pathways = numpy.full(len(edge_keys_all), "", dtype=object)
+edge_new_pathways[numpy.searchsorted(edge_keys_all, new_keys)] = new_edge_pathways
+
+print("**********************")
+print(f"Old Nodes: {len(old['ids'])}")
+print(f"New Nodes: {len(new['ids'])}")
+for change in ["added", "removed", "changed"]:
+    print(f"{change.capitalize()} Nodes: {numpy.count_nonzero(node_change == change)}")
+print("**********************")
+print(f"Old Edges: {len(old_keys)}")
+print(f"New Edges: {len(new_keys)}")
+for change in ["added", "removed", "changed"]:
+    print(f"{change.capitalize()} Edges: {numpy.count_nonzero(edge_change == change)}")
+if numpy.any(both & ~numpy.isnan(heat_delta)):
+    print("**********************")
+    print(f"Mean Absolute Heat Delta (Shared Nodes): {numpy.nanmean(numpy.abs(heat_delta[both])):.4f}")
+    print(f"Max Absolute Heat Delta (Shared Nodes): {numpy.nanmax(numpy.abs(heat_delta[both])):.4f}")
+print("**********************")
+
+
+def number(x):
+    return "" if numpy.isnan(x) else f"{x}"
+
+
+def pathway_change(old_pathways, new_pathways):
+    old_set = set(p for p in old_pathways.split(",") if p)
+    new_set = set(p for p in new_pathways.split(",") if p)
+    return ",".join([f"-{p}" for p in sorted(old_set - new_set)] + [f"+{p}" for p in sorted(new_set - old_set)])
+
+
+def node_detail(i):
+    details = []
+    if o["class"][i] != n["class"][i]:
+        details.append(f"class {o['class'][i]}>{n['class'][i]}")
+    if o["label"][i] != n["label"][i]:
+        details.append(f"label {o['label'][i]}>{n['label'][i]}")
+    if fc_differs[i]:
+        details.append(f"Log2FC {number(o['fc'][i])}>{number(n['fc'][i])}")
+    if o["pathways"][i] != n["pathways"][i]:
+        details.append(f"pathways {pathway_change(o['pathways'][i], n['pathways'][i])}")
+    return "; ".join(details)
+
+
+node_class = numpy.where(n["present"], n["class"], o["class"])
+node_label = numpy.where(n["label"] != "", n["label"], o["label"])
+node_label = numpy.where(node_label != "", node_label, vocab.astype(object))
+
+with open("heatwave_diff.tsv", 'w') as out:
+    print("Change\tElement\tClass\tID\tLabel\tOld_Heat\tNew_Heat\tHeat_Delta\tDetail", file=out)
+    for change in ["added", "removed", "changed"]:  # hottest changes first
+        idx = numpy.flatnonzero(node_change == change)
+        magnitude = numpy.nan_to_num(numpy.abs(heat_delta[idx]) if change == "changed" else numpy.fmax(o["heat"][idx], n["heat"][idx]))
+        for i in idx[numpy.lexsort((idx, -magnitude))]:
+            detail = node_detail(i) if change == "changed" else ""
+            print(f"{change}\tnode\t{node_class[i]}\t{vocab[i]}\t{node_label[i]}\t{number(o['heat'][i])}\t{number(n['heat'][i])}\t{number(heat_delta[i])}\t{detail}", file=out)
+    for change in ["added", "removed", "changed"]:
+        for e in numpy.flatnonzero(edge_change == change):
+            detail = f"pathways {pathway_change(edge_old_pathways[e], edge_new_pathways[e])}" if change == "changed" else ""
+            print(f"{change}\tedge\t\t{vocab[edge_source[e]]}|{vocab[edge_target[e]]}\t\t\t\t\t{detail}", file=out)
+
+######################################################
+
+from matplotlib import colors
+from matplotlib.colors import LinearSegmentedColormap
+
+color_list = [colors.to_rgb(cold_color) ,(1,1,1), colors.to_rgb(hot_color)]
+cmap = LinearSegmentedColormap.from_list('custom', color_list, N=256)
+
+
+def fc(fc_in):
+    fc_out = (fc_in + 3) / 6.0
+    return colors.to_hex(cmap(fc_out))
+
+
+# Combined view: both sides when small enough, otherwise at most view_limit nodes with changes or changed edges
+# (largest heat change first, then nodes changed themselves, then the most changed edges), plus the edges
+# between the shown nodes for context
+shown = o["present"] | n["present"]
+if numpy.count_nonzero(shown) > view_limit:
+    changed_edges = edge_change != ""
+    edge_changes = numpy.bincount(edge_source[changed_edges], minlength=V) + numpy.bincount(edge_target[changed_edges], minlength=V)
+    candidates = numpy.flatnonzero((node_change != "") | (edge_changes > 0))
+    magnitude = numpy.nan_to_num(numpy.where(both, numpy.abs(heat_delta), numpy.fmax(o["heat"], n["heat"])))[candidates]
+    ranked = candidates[numpy.lexsort((candidates, -edge_changes[candidates], node_change[candidates] == "", -magnitude))]
+    shown = numpy.zeros(V, dtype=bool)
+    shown[ranked[:view_limit]] = True
+    left_out_edges = numpy.count_nonzero(changed_edges & ~(shown[edge_source] & shown[edge_target]))
+    print(f"Diff View: {numpy.count_nonzero(shown)} of {len(candidates)} nodes with changes or changed edges, {left_out_edges} changed edges left out (see heatwave_diff.tsv)")
+    print("**********************")
+D = nx.DiGraph()
+view_label = {}
+for i in numpy.flatnonzero(shown):
+    node_id = vocab[i]
+    view_label[node_id] = node_label[i]
+    if node_change[i] == "changed" and not numpy.isnan(heat_delta[i]):
+        view_label[node_id] = f"{node_label[i]} ({heat_delta[i]:+.2f})"
+    node_fc = n["fc"][i] if n["present"][i] else o["fc"][i]
+    D.add_node(node_id, change=node_change[i], bg=fc(node_fc) if not numpy.isnan(node_fc) else "#D3D3D3")
+    (D.nodes[node_id]["shape"], D.nodes[node_id]["url"]) = heatwave_view.node_link(node_class[i], node_id)
+for e in numpy.flatnonzero(shown[edge_source] & shown[edge_target]):
+    D.add_edge(vocab[edge_source[e]], vocab[edge_target[e]], change=edge_change[e])
+
+viz = open("heatwave_diff.html", 'w')
+print(heatwave_view.view_head, file=viz)
+for node_id in D.nodes:
+    change = f'change: "{D.nodes[node_id]["change"]}",\n            ' if D.nodes[node_id]["change"] else ""
+    print(f"""
+        {{
+          data: {{
+            id: "{node_id}",
+            label: {json.dumps(view_label[node_id])},
+            bg: "{D.nodes[node_id]['bg']}",
+            url: "{D.nodes[node_id]['url']}",
+            {change}shape: "{D.nodes[node_id]['shape']}"
+          }}
+        }},
+    """, file=viz)
+print("""
+                      ],
+                      edges: [
+""", file=viz)
+for edge in D.edges:
+    change = f',\n        change: "{D.edges[edge]["change"]}"' if D.edges[edge]["change"] else ""
+    print(f"""
+    {{
+      data: {{
+        id: "{edge[0]}|{edge[1]}",
+        source: "{edge[0]}",
+        target: "{edge[1]}"{change}
+      }}
+    }},
+    """, file=viz)
+print(heatwave_view.view_script, file=viz)
+print(heatwave_view.index_script % json.dumps(heatwave_view.view_index(D, view_label)), file=viz)
+print(heatwave_view.view_tail, file=viz)
+viz.close()
@@ -0,0 +1,70 @@
+import os
+import struct
+import numpy
+
+#
+# Per-wave heat history: a small binary file holding the heat of every network node after every wave
+# (row 0 is the initial heat, row t the heat after wave t), written one float32 row per wave while the
+# diffusion runs.  Layout:
+#
+#   b"HWHIST1\n" | uint64 node count | uint64 byte length of node IDs | node IDs ("\n"-joined, padded to 8 bytes) | float32 rows
+#
+# The number of waves is not stored, it follows from the file size, so a file can be read while it is still being written.
+#
+# Reading, e.g. the heat of the first 100 nodes over waves 10..19, only touches those rows:
+#
+#   import heatwave_history
+#   (node_ids, heat) = heatwave_history.open_history("heatwave_history.bin")
+#   block = heat[10:20, :100]
+#
+
+MAGIC = b"HWHIST1\n"
+HEADER = struct.Struct("<8sQQ")
+
+
+class HistoryWriter:
+    def __init__(self, fname, node_ids):
+        self.node_count = len(node_ids)
+        self.waves = 0
+        ids = "\n".join(node_ids).encode()
+        self.file = open(fname, 'wb')
+        self.file.write(HEADER.pack(MAGIC, self.node_count, len(ids)))
+        self.file.write(ids)
+        self.file.write(b"\0" * (-len(ids) % 8))
+
+    def append(self, heat):
+        assert len(heat) == self.node_count
+        self.file.write(numpy.asarray(heat, dtype="<f4").tobytes())
+        self.waves += 1
+
+    def close(self):
+        self.file.close()
+
+
+def open_history(fname):
+    # Returns the node IDs (in node index order) and a read-only (wave x node) float32 memmap
+    with open(fname, 'rb') as f:
+        (magic, node_count, ids_length) = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{fname} is not a heat history file")
+        node_ids = f.read(ids_length).decode().split("\n") if node_count else []
+    offset = HEADER.size + ids_length + (-ids_length % 8)
+    waves = (os.path.getsize(fname) - offset) // (4 * node_count) if node_count else 0
+    if waves == 0:
+        return (node_ids, numpy.zeros((0, node_count), dtype="<f4"))
+    heat = numpy.memmap(fname, dtype="<f4", mode='r', offset=offset, shape=(waves, node_count))
+    return (node_ids, heat)
+
+
+def read_history(fname, nodes=slice(None), waves=slice(None)):
+    # Copies out the selected (wave x node) block, reading only the selected rows; nodes/waves may be ints, slices or
+    # index arrays. Node indices follow the order of the returned node IDs of open_history(): the network file order,
+    # or under a pathway selection the order in which the union of the selected shards was loaded.
+    (node_ids, heat) = open_history(fname)
+    if isinstance(waves, (int, numpy.integer)):
+        waves = [waves]
+    if isinstance(nodes, (int, numpy.integer)):
+        nodes = [nodes]
+    if not isinstance(waves, slice) and not isinstance(nodes, slice):
+        return numpy.array(heat[numpy.ix_(waves, nodes)])
+    return numpy.array(heat[waves, nodes])
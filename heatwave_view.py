@@ -0,0 +1,499 @@
+import re
+import networkx as nx
+
+#
+# Cytoscape.js view shared by analyze_metagenomic_data.py (heatwave.html) and diff_metagenomic_data.py
+# (heatwave_diff.html): the page is view_head, the node and edge elements, view_script, index_script
+# (filled with view_index()), optionally cluster_script, and view_tail.
+#
+# Nodes carry id/label/bg/url/shape data, supernodes of the aggregated view members/heat, and the
+# elements of a diff view a change ("added", "removed" or "changed") that is highlighted by color.
+#
+
+
+def node_link(node_class, node_id):
+    # (shape, url) of a network node
+    if node_class == "reaction":
+        return ("rectangle", f"https://www.genome.jp/entry/{node_id}")
+    return ("ellipse", f"https://www.ebi.ac.uk/chebi/advancedSearchFT.do?searchString={node_id}")
+
+
+def view_index(H, node_label):
+    # Search and neighborhood indexes for the viewer ("f" and "e"), so it never has to scan the graph:
+    # a sorted (key, node) prefix index over lower-cased IDs, labels and label words, and CSR adjacency arrays
+    nodes = list(H.nodes)
+    position = {n: i for (i, n) in enumerate(nodes)}
+    keys = set()
+    for (i, n) in enumerate(nodes):
+        for key in [n, node_label[n]] + re.split(r"[\s,;]+", node_label[n]):
+            if key:
+                keys.add((key.lower(), i))
+    keys = sorted(keys)
+    offsets = [0]
+    neighbors = []
+    for n in nodes:
+        neighbors.extend(sorted(set(position[m] for m in nx.all_neighbors(H, n))))
+        offsets.append(len(neighbors))
+    return {
+        "nodes": nodes,
+        "labels": [node_label[n] for n in nodes],
+        "keys": [key for (key, i) in keys],
+        "key_nodes": [i for (key, i) in keys],
+        "offsets": offsets,
+        "neighbors": neighbors}
+
+
+view_head = """
+    <html>
+    <head>
+    <title>Multi-Omic HeatWave Visualization</title>
+    <meta name="viewport" content="width=device-width, user-scalable=no, initial-scale=1, maximum-scale=1">
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/cytoscape/3.23.0/cytoscape.min.js"></script>
+    <script src="https://cdn.jsdelivr.net/gh/cytoscape/cytoscape.js-pdf-export@main/dist/cytoscape-pdf-export.js"></script>    
+    <style>
+            body {
+                font-family: helvetica;
+                font-size: 14px;
+            }
+
+            #cy {
+                width: 100%;
+                height: 100%;
+                position: absolute;
+                left: 0;
+                top: 0;
+                z-index: 999;
+            }
+
+            h1 {
+                opacity: 0.5;
+                font-size: 1em;
+            }
+        </style>
+
+        <script>
+            var checkpoint = null;
+            var change_colors = { added: '#2CA02C', removed: '#D62728', changed: '#FF7F0E' };
+            var checkpoint_style = [{
+                    selector: 'node',
+                    labelValign: 'middle',
+                    style: {
+                        'text-valign': function(ele) {if (ele.data('shape') === "ellipse") { return "top" } else { return "top" } },
+                        'width': function(ele) {if (ele.data('shape') === "ellipse") { return 30 } else { return 30 } },
+                        'height': function(ele) {if (ele.data('shape') === "ellipse") { return 30 } else { return 30 } },
+                        'font-weight': function(ele) { if (ele.data('shape') === "ellipse") { return 'bold' } else { return "normal" } },
+                        'font-size': function(ele) { if (ele.data('shape') === "ellipse") { return '16px' } else { return "12px" } },
+                        'color': function(ele) { if (ele.data('shape') === "ellipse") { return 'darkblue' } else { return "black" } },
+                        'content': 'data(label)',
+                        'border-width': 1,
+                        //'border-color': 'black',
+                        'background-color': function(ele) { return ele.data('bg') },
+                        'shape': function(ele) { return ele.data('shape') }
+                    }
+                },
+
+
+                {
+                    selector: 'edge',
+                    style: {
+                        'curve-style': 'bezier',
+                        'source-arrow-shape': 'triangle',
+                        'target-arrow-shape': 'triangle'
+                    },
+                    css: {
+                        'line-color': '#cccbcb' //'#f92411'
+                    }
+                },
+
+                {
+                    selector: 'node[members]',
+                    style: {
+                        'width': function(ele) { return 30 + 8 * Math.sqrt(ele.data('members')) },
+                        'height': function(ele) { return 30 + 8 * Math.sqrt(ele.data('members')) },
+                        'font-size': '16px'
+                    }
+                },
+
+                {
+                    selector: 'edge[weight]',
+                    style: {
+                        'width': function(ele) { return Math.min(1 + Math.log2(ele.data('weight')), 8) }
+                    }
+                },
+
+                {
+                    selector: 'node[change]',  // diff views (diff_metagenomic_data.py)
+                    style: {
+                        'border-width': 6,
+                        'border-color': function(ele) { return change_colors[ele.data('change')] }
+                    }
+                },
+
+                {
+                    selector: 'edge[change]',
+                    style: {
+                        'width': 4,
+                        'line-color': function(ele) { return change_colors[ele.data('change')] },
+                        'source-arrow-color': function(ele) { return change_colors[ele.data('change')] },
+                        'target-arrow-color': function(ele) { return change_colors[ele.data('change')] }
+                    }
+                },
+
+                {
+                    selector: '[change = "removed"]',
+                    style: {
+                        'border-style': 'dashed',
+                        'line-style': 'dashed',
+                        'opacity': 0.6
+                    }
+                },
+
+                {
+                    selector: ':selected',
+                    style: {
+                        'background-color': 'purple',
+                        'line-color': 'purple',
+                        'source-arrow-color': 'purple',
+                        'target-arrow-color': 'purple'
+                    }
+                }
+            ];        
+            document.addEventListener('DOMContentLoaded', function(){
+
+                var cy = window.cy = cytoscape({
+                    container: document.getElementById('cy'),
+
+                    autounselectify: false,
+                    
+                    boxSelectionEnabled: true,
+
+                    layout: {
+                        name: 'cose',
+                        nodeOverlap: 1000,
+                        animate: false,
+                        //idealEdgeLength: 50,
+                        nodeDimensionsIncludeLabels: false,
+                    },
+
+                    style: checkpoint_style,
+
+                    elements: {
+                      nodes: [
+"""
+
+view_script = """
+                      ]
+                    }
+                });
+                cy.on('tap', 'node[url]', function(){
+                    try { // your browser may block popups
+                        window.open( this.data('url') );
+                    } catch(e){ // fall back on url change
+                        window.location.href = this.data('url');
+                    }
+                }); 
+
+"""
+
+index_script = """
+                window.view_index = %s;
+                view_index.position = {};
+                view_index.nodes.forEach(function(id, i) { view_index.position[id] = i; });
+"""
+
+cluster_script = """
+                window.clusters = %s;
+                window.cluster_of = %s;
+                window.visible_id = function(n) {  // a member of a collapsed cluster is represented by its supernode
+                    var c = cluster_of[n];
+                    return (c !== undefined && cy.getElementById(c).length > 0) ? c : n;
+                };
+                window.expand_cluster = function(cid) {
+                    var supernode = cy.getElementById(cid);
+                    if (supernode.length === 0) { return; }
+                    var pos = supernode.position();
+                    var members = clusters[cid].nodes;
+                    var r = 20 * Math.sqrt(members.length);
+                    cy.remove(supernode);
+                    cy.add(members.map(function(d, i) {
+                        var a = 2 * Math.PI * i / members.length;
+                        return { group: 'nodes', data: d, position: { x: pos.x + r * Math.cos(a), y: pos.y + r * Math.sin(a) } };
+                    }));
+                    var seen = new Set();
+                    var edges = [];
+                    clusters[cid].edges.forEach(function(e) {
+                        var s = visible_id(e[0]);
+                        var t = visible_id(e[1]);
+                        if (s === t || seen.has(s + '|' + t) || cy.getElementById(s).length === 0 || cy.getElementById(t).length === 0) { return; }
+                        seen.add(s + '|' + t);
+                        edges.push({ group: 'edges', data: { id: s + '|' + t, source: s, target: t } });
+                    });
+                    cy.add(edges);
+                };
+                cy.on('tap', 'node[members]', function(){
+                    expand_cluster(this.id());
+                });
+"""
+
+view_tail = """            });
+        </script>
+    </head>
+
+<body>
+    <div id="cy"></div>
+    <div id="search" style="display: none; position: absolute; top: 10px; left: 10px; z-index: 1000; background: white; border: 1px solid #999; padding: 4px;">
+        <input id="search_input" type="text" size="40" placeholder="Label or ID prefix (enter = select all, esc = close)">
+        <div id="search_results"></div>
+    </div>
+    <script type="text/javascript">
+    // view_index (written by analyze_metagenomic_data.py) holds a sorted prefix index over lower-cased IDs, labels
+    // and label words (keys/key_nodes) and CSR adjacency arrays (offsets/neighbors), both over node positions in nodes.
+
+    function search_matches(prefix, limit) {
+        var keys = view_index.keys;
+        var lo = 0;
+        var hi = keys.length;
+        while (lo < hi) {  // first key >= prefix
+            var mid = (lo + hi) >> 1;
+            if (keys[mid] < prefix) { lo = mid + 1; } else { hi = mid; }
+        }
+        var seen = new Set();
+        var matches = [];
+        for (var k = lo; k < keys.length && keys[k].startsWith(prefix) && matches.length < limit; k++) {
+            var i = view_index.key_nodes[k];
+            if (!seen.has(i)) {
+                seen.add(i);
+                matches.push(i);
+            }
+        }
+        return matches;
+    }
+
+    function shown_node(id) {  // expands the collapsed cluster holding id, if any
+        var ele = cy.getElementById(id);
+        if (ele.length === 0 && window.cluster_of && cluster_of[id] !== undefined) {
+            expand_cluster(cluster_of[id]);
+            ele = cy.getElementById(id);
+        }
+        return ele;
+    }
+
+    function select_matches(matches) {
+        var eles = cy.collection();
+        matches.forEach(function(i) { eles = eles.union(shown_node(view_index.nodes[i])); });
+        eles.select();
+        if (eles.length > 0) {
+            cy.center(eles);
+        }
+    }
+
+    function update_search() {
+        var prefix = document.getElementById("search_input").value.trim().toLowerCase();
+        var results = document.getElementById("search_results");
+        results.innerHTML = "";
+        if (!prefix) {
+            return;
+        }
+        search_matches(prefix, 20).forEach(function(i) {
+            var item = document.createElement("div");
+            item.style.cursor = "pointer";
+            item.textContent = view_index.labels[i] + " (" + view_index.nodes[i] + ")";
+            item.onclick = function() { select_matches([i]); };
+            results.appendChild(item);
+        });
+    }
+
+    function open_search() {
+        document.getElementById("search").style.display = "block";
+        var input = document.getElementById("search_input");
+        input.value = "";
+        update_search();
+        input.focus();
+    }
+
+    document.getElementById("search_input").addEventListener("input", update_search);
+    document.getElementById("search_input").addEventListener("keydown", function(event) {
+        if (event.key === "Enter") {
+            var prefix = this.value.trim().toLowerCase();
+            if (prefix) {
+                select_matches(search_matches(prefix, view_index.nodes.length));
+            }
+        }
+        if (event.key === "Enter" || event.key === "Escape") {
+            document.getElementById("search").style.display = "none";
+            this.blur();
+            event.preventDefault();
+        }
+    });
+
+    function expand_selection() {
+        var neighbors = cy.collection();
+        cy.nodes(":selected").forEach(function(n) {
+            var i = view_index.position[n.id()];
+            if (i === undefined) {  // e.g. a cluster supernode
+                neighbors = neighbors.union(n.neighborhood());
+                return;
+            }
+            for (var k = view_index.offsets[i]; k < view_index.offsets[i + 1]; k++) {
+                var id = view_index.nodes[view_index.neighbors[k]];
+                if (window.visible_id) {
+                    id = visible_id(id);
+                }
+                var m = cy.getElementById(id);
+                if (m.length === 0) {
+                    continue;
+                }
+                neighbors = neighbors.union(m).union(cy.getElementById(n.id() + "|" + id)).union(cy.getElementById(id + "|" + n.id()));
+            }
+        });
+        neighbors.select();
+    }
+
+    document.addEventListener(
+        "keydown",
+        (event) => {
+            const keyName = event.key;
+
+            if (event.target.tagName === "INPUT") {  // typing into the search box
+                return;
+            }
+
+            if (keyName === "f") {
+                open_search();
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "e") {
+                expand_selection();
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "d") {
+                if (event.altKey) {
+                    cy.remove(cy.elements(":unselected"));
+                    cy.elements(":selected").unselect();
+                } else {
+                    cy.remove(cy.elements(":selected"));
+                }
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "Delete") {
+                if (event.altKey) {
+                    cy.remove(cy.elements(":unselected"));
+                    cy.elements(":selected").unselect();
+                } else {
+                    cy.remove(cy.elements(":selected"));
+                }
+                event.preventDefault();
+                return;
+            }
+
+
+            if (keyName === "D") {
+                cy.remove(cy.elements(":unselected"));
+                cy.elements(":selected").unselect();
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "l") {
+                cy.layout({
+                    name: 'cose',
+                    nodeOverlap: 1000,
+                    animate: false,
+                    // idealEdgeLength: 64,
+                    nodeDimensionsIncludeLabels: true,
+                }).run()
+                event.preventDefault();
+                return;
+            }
+
+
+            if (keyName === "c") {
+                if (event.altKey) {
+                    if (checkpoint) {
+                        cy.json(checkpoint);
+                    }
+                } else {
+                    checkpoint = cy.json()
+                    checkpoint.style = checkpoint_style;
+                }
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "C") {
+                if (checkpoint) {
+                    cy.json(checkpoint);
+                }
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "p") {
+                cy.pdf({ bg: '#FFF', save: true, full: true })
+            }
+
+
+            if (keyName === "s") {
+
+                const link = document.createElement("a");
+                const content = JSON.stringify(cy.json());
+                const file = new Blob([content], { type: 'application/json' });
+                link.href = URL.createObjectURL(file);
+                link.download = "network.json";
+                link.click();
+                URL.revokeObjectURL(link.href);
+            }
+
+            if (keyName === "x") {
+                if (window.expand_cluster) {
+                    cy.nodes(':selected').filter('[members]').forEach(function(n) { expand_cluster(n.id()) });
+                }
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "n") {
+                alert('This network has ' + cy.nodes().length + ' nodes and ' + cy.edges().length + ' edges.')
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "h") {
+                alert('f = find (search as you type)\\ne = expand selection\\nd = delete selection\\ndelete-key = delete selection\\nalt-d = delete non-selected\\nshift-d = delete non-selected\\nalt-delete-key = delete non-selected\\nl = layout\\nc = checkpoint\\nalt-c = reset to checkpoint\\nshift-c = reset to checkpoint\\np = print to pdf\\ns = save to json_file\\ni = import json_file\\nx = expand selected clusters\\nn = show network stats\\nh = help')
+                event.preventDefault();
+                return;
+            }
+
+            if (keyName === "i") {
+                var input = document.createElement('input');
+                input.type = 'file';
+
+                input.onchange = e => {
+                    var file = e.target.files[0];
+                    var reader = new FileReader();
+                    reader.readAsText(file, 'UTF-8');
+
+                    reader.onload = readerEvent => {
+                        var content = readerEvent.target.result;
+
+                        checkpoint = JSON.parse(content);
+                        checkpoint.style = checkpoint_style;
+                        cy.json(checkpoint);
+                    }
+                }
+
+                input.click();
+            }
+        },
+        false,
+    );
+    </script>
+</body>
+
+</html>"""
@@ -0,0 +1,83 @@
+import sys
+import time
+import json
+import threading
+import http.server
+
+#
+# A tiny local stand-in for the KEGG and PubChem REST APIs, to check create_metagenomic_network.py offline:
+#
+#   python mock_rest_server.py 8765 1
+#   python create_metagenomic_network.py mock_cache mock_network.tsv http://127.0.0.1:8765/kegg http://127.0.0.1:8765/pug
+#
+# It serves a fixed network of a few compounds, reactions, orthologs, pathways and a module under /kegg/ and /pug/,
+# waits the given number of seconds (second argument) before every answer to mimic slow downloads, and reports the
+# number of requests per path at /counts.  A cold build (empty cache) makes 16 requests, so with a delay of 1 s
+# fetching them one after another would take at least 16 s; the pipelined build only waits for its longest
+# chain of dependent downloads and finishes in about 2.5 s.
+#
+
+port = 8765
+if len(sys.argv) > 1:
+    port = int(sys.argv[1])
+
+delay = 0.0
+if len(sys.argv) > 2:
+    delay = float(sys.argv[2])
+
+compounds = {f"C{i:05d}": (f"Name{i}" if i not in (5, 6) else "Dup") for i in range(1, 9)}  # C00005/C00006 share a name
+
+kegg = {
+    "list/compound": "\n".join(f"{c}\t{name}; alias" for (c, name) in compounds.items()),
+    "list/gl": "G00001\tSomeGlycan",
+    "list/rn": "R00001\tfoo; Name1 + Name2 <=> Name3 + Dup\nR00002\tbar; Name4 <=> 2 Name2\nR00003\tbaz; Name7 <=> Name8 + SomeGlycan",
+    "link/ko/rn": "rn:R00001\tko:K00001\nrn:R00001\tko:K00011\nrn:R00002\tko:K00002\nrn:R00003\tko:K00003",
+    "list/pathway": "map00010\tGlycolysis\nmap00020\tTCA",
+    "list/module": "M00001\tMod one",
+    "link/pathway/ko": "ko:K00001\tpath:map00010\nko:K00001\tpath:ko00010\nko:K00002\tpath:map00020\nko:K00003\tpath:map00020",
+    "link/pathway/compound": "cpd:C00001\tpath:map00010\ncpd:C00003\tpath:map00010\ncpd:C00007\tpath:map00020\ncpd:C00008\tpath:map00010",
+    "link/module/ko": "ko:K00001\tmd:M00001",
+    "link/module/compound": "cpd:C00002\tmd:M00001",
+    "get/C00005": "ENTRY C00005\nREACTION    R00001 R00002\n            R00003\nPATHWAY x",
+    "get/C00006": "ENTRY C00006\nREACTION    R00009"}
+
+pubchem = {
+    "substance/sourceall/KEGG/xrefs/RegistryID/json": json.dumps({"InformationList": {"Information": [{"SID": 100 + i, "RegistryID": [c]} for (i, c) in enumerate(compounds)]}}),
+    "substance/sourceall/KEGG/cids/json?list_return=listkey": json.dumps({"IdentifierList": {"ListKey": "LK1"}}),
+    "compound/listkey/LK1/property/inchikey/json": json.dumps({"PropertyTable": {"Properties": [{"CID": 1000 + i, "InChIKey": f"KEY{i:011d}-XX-N"} for i in range(len(compounds))]}}),
+    "substance/sourceall/KEGG/cids/json": json.dumps({"InformationList": {"Information": [{"SID": 100 + i, "CID": [1000 + i]} for i in range(len(compounds))]}})}
+
+counts = {}
+counts_lock = threading.Lock()
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_GET(self):
+        if self.path == "/counts":
+            with counts_lock:
+                self.reply(200, json.dumps(counts))
+            return
+        with counts_lock:
+            counts[self.path] = counts.get(self.path, 0) + 1
+        time.sleep(delay)
+        body = None
+        if self.path.startswith("/kegg/"):
+            body = kegg.get(self.path[len("/kegg/"):])
+        if self.path.startswith("/pug/"):
+            body = pubchem.get(self.path[len("/pug/"):])
+        if body is None:
+            self.reply(404, "not found")
+        else:
+            self.reply(200, body)
+
+
+print(f"Serving mock KEGG/PubChem REST APIs on http://127.0.0.1:{port}/kegg and http://127.0.0.1:{port}/pug ({delay} s per request)")
+http.server.ThreadingHTTPServer(("127.0.0.1", port), MockHandler).serve_forever()